@@ -1,25 +1,38 @@
 import logging
+import math
 import os
 import re
 import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime, timezone
 from decimal import Decimal, InvalidOperation
 from pathlib import Path
 
+import click
 from dotenv import load_dotenv
 from flask import Flask, jsonify, redirect, render_template, request, send_file, session, url_for
 from flask_cors import CORS
 import stripe
 
+from app_state import get_app_state_store
 from auth import authenticate_request
+from cache import StaleWhileRevalidateCache
+from database import end_request_transaction, init_request_sessions
 from device_registry import get_device_registry
 from errors import APIError, handle_errors, validate_amount_cents
+from login_throttle import LoginThrottle
+from password_hashing import calibrate_method, get_password_hash_executor
+from payments import get_payment_store
 from products import get_product_store
-from users import Role, get_user_store
+from stripe_client import STRIPE_HTTP_POOL_SIZE, configure_stripe
+from users import LastActiveAdminError, Role, UserSnapshot, get_user_store
 
 load_dotenv()
 
 app = Flask(__name__)
+init_request_sessions(app)
 
 # Logging setup
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
@@ -35,8 +48,8 @@ app.secret_key = FLASK_SECRET_KEY
 STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY")
 if not STRIPE_SECRET_KEY:
     raise RuntimeError("STRIPE_SECRET_KEY is not set. Provide it via environment variable or .env file.")
-stripe.api_key = STRIPE_SECRET_KEY
-stripe.api_version = "2024-06-20"
+# Stripe calls can take seconds; the request session must not pin a pooled connection meanwhile.
+configure_stripe(STRIPE_SECRET_KEY, api_version="2024-06-20", before_request=end_request_transaction)
 
 # CORS configuration
 raw_origins = os.getenv("ALLOWED_ORIGINS", "*")
@@ -54,7 +67,40 @@ STRIPE_LOCATION_ADDRESS = {
 }
 APK_DOWNLOAD_DIR = Path(os.getenv("APK_DOWNLOAD_DIR", Path(__file__).resolve().parents[1] / "artifacts"))
 APK_FILENAME_PATTERN = re.compile(r"club-payment-(?P<version>\d+(?:\.\d+)*)-release-signed\.apk$")
+_APK_INFO_CACHE: tuple | None = None
 APP_VERSION = os.getenv("APP_VERSION", "1.0.15")
+CLUB_NAME = "DARC e.V. OV L11"
+PAYMENT_SYNC_INTERVAL_SECONDS = int(os.getenv("PAYMENT_SYNC_INTERVAL_SECONDS", "0"))
+PAYMENT_SYNC_LOOKBACK_SECONDS = int(os.getenv("PAYMENT_SYNC_LOOKBACK_SECONDS", "3600"))
+PAYMENT_SYNC_HIGH_WATER_KEY = "payments.sync.high_water_created"
+PAYMENT_SYNC_CURSOR_KEY = "payments.sync.starting_after"
+PAYMENT_SYNC_RUN_MAX_KEY = "payments.sync.run_max_created"
+PAYMENT_SYNC_RETRY_FROM_KEY = "payments.sync.retry_from_created"
+ADMIN_PAYMENTS_CACHE_TTL_SECONDS = int(os.getenv("ADMIN_PAYMENTS_CACHE_TTL_SECONDS", "60"))
+STRIPE_PREFETCH_WORKERS = int(os.getenv("STRIPE_PREFETCH_WORKERS", "8"))
+STRIPE_PREFETCH_DEADLINE_SECONDS = float(os.getenv("STRIPE_PREFETCH_DEADLINE_SECONDS", "10"))
+# One pool for every page render, cache refresh and sync run, never wider than the Stripe HTTP pool.
+_STRIPE_PREFETCH_EXECUTOR = ThreadPoolExecutor(
+    max_workers=max(min(STRIPE_PREFETCH_WORKERS, STRIPE_HTTP_POOL_SIZE), 1),
+    thread_name_prefix="stripe-prefetch",
+)
+PAYOUT_RECONCILE_INTERVAL_SECONDS = int(os.getenv("PAYOUT_RECONCILE_INTERVAL_SECONDS", "300"))
+PAYOUT_RECONCILE_LIMIT = int(os.getenv("PAYOUT_RECONCILE_LIMIT", "20"))
+PAYOUT_RECONCILED_AT_KEY = "payouts.reconciled_at"
+STRIPE_PAYMENT_INTENT_EXPAND = ["data.latest_charge", "data.latest_charge.balance_transaction"]
+_PAYMENT_SYNC_LOCK = threading.Lock()
+ADMIN_DEVICES_MAX_PAGE_SIZE = 500
+ADMIN_DEVICE_FIELDS = ("device_id", "user_id", "name", "username", "role", "active")
+ADMIN_PENDING_DEVICES_PAGE_SIZE = max(int(os.getenv("ADMIN_PENDING_DEVICES_PAGE_SIZE", "50")), 1)
+LOGIN_THROTTLE_BURST = int(os.getenv("LOGIN_THROTTLE_BURST", "5"))
+LOGIN_THROTTLE_REFILL_PER_MINUTE = float(os.getenv("LOGIN_THROTTLE_REFILL_PER_MINUTE", "10"))
+LOGIN_THROTTLE_MAX_KEYS = int(os.getenv("LOGIN_THROTTLE_MAX_KEYS", "10000"))
+_LOGIN_THROTTLE = LoginThrottle(LOGIN_THROTTLE_BURST, LOGIN_THROTTLE_REFILL_PER_MINUTE, LOGIN_THROTTLE_MAX_KEYS)
+WEB_USER_SNAPSHOT_SESSION_KEY = "admin_user"
+WEB_USER_SNAPSHOT_MAX_AGE_SECONDS = int(os.getenv("WEB_USER_SNAPSHOT_MAX_AGE_SECONDS", "60"))
+TERMINAL_LOCATION_STATE_KEY = "stripe.terminal.location_id"
+_TERMINAL_LOCATION_LOCK = threading.Lock()
+_TERMINAL_LOCATION_ID: str | None = None
 
 
 @app.context_processor
@@ -65,15 +111,56 @@ def _template_context() -> dict:
     }
 
 
+def _remember_web_user(user, version: str) -> None:
+    session["admin_user_id"] = user.id
+    session[WEB_USER_SNAPSHOT_SESSION_KEY] = {
+        "id": user.id,
+        "name": user.name,
+        "username": user.username,
+        "role": user.role.value,
+        "active": user.active,
+        "version": version,
+        "cached_at": time.time(),
+    }
+
+
+def _forget_web_user() -> None:
+    session.pop("admin_user_id", None)
+    session.pop(WEB_USER_SNAPSHOT_SESSION_KEY, None)
+
+
+def _web_user_from_snapshot(user_id: int) -> UserSnapshot | None:
+    snapshot = session.get(WEB_USER_SNAPSHOT_SESSION_KEY)
+    if not isinstance(snapshot, dict) or snapshot.get("id") != user_id:
+        return None
+    if time.time() - snapshot.get("cached_at", 0) > WEB_USER_SNAPSHOT_MAX_AGE_SECONDS:
+        return None
+    if snapshot.get("version") != get_user_store().user_version(user_id):
+        return None
+    return UserSnapshot(
+        id=user_id,
+        name=snapshot["name"],
+        role=Role(snapshot["role"]),
+        active=snapshot["active"],
+        username=snapshot["username"],
+    )
+
+
 def _get_web_user_from_session():
     user_id = session.get("admin_user_id")
     if not isinstance(user_id, int):
         return None
+    cached_user = _web_user_from_snapshot(user_id)
+    if cached_user:
+        return cached_user
     store = get_user_store()
+    # Stamp with the version seen before the read, so a change committed in between invalidates it.
+    version = store.user_version(user_id)
     user = store.get_by_id(user_id)
     if not user or not user.active or user.role not in {Role.ADMIN, Role.KASSIERER}:
-        session.pop("admin_user_id", None)
+        _forget_web_user()
         return None
+    _remember_web_user(user, version)
     return user
 
 
@@ -97,38 +184,68 @@ def _version_key(version: str) -> tuple[int, ...]:
     return tuple(int(part) for part in version.split("."))
 
 
-def _latest_apk_info() -> dict | None:
-    apk_dir = Path(APK_DOWNLOAD_DIR)
-    if not apk_dir.exists():
-        return None
-
+def _scan_latest_apk(apk_dir: Path) -> dict | None:
     candidates = []
     for apk_path in apk_dir.glob("club-payment-*-release-signed.apk"):
         match = APK_FILENAME_PATTERN.fullmatch(apk_path.name)
         if not match:
             continue
         version = match.group("version")
+        apk_stat = apk_path.stat()
         candidates.append((
             _version_key(version),
-            apk_path.stat().st_mtime,
+            apk_stat.st_mtime,
             apk_path,
             version,
+            apk_stat.st_size,
         ))
     if not candidates:
         return None
 
-    _, _, apk_path, version = max(candidates, key=lambda item: (item[0], item[1], item[2].name))
+    _, modified_at, apk_path, version, size = max(candidates, key=lambda item: (item[0], item[1], item[2].name))
     return {
         "path": apk_path,
+        "modified_at": modified_at,
         "filename": apk_path.name,
         "version": version,
-        "size_mb": f"{apk_path.stat().st_size / 1024 / 1024:.1f}".replace(".", ","),
+        "size_mb": f"{size / 1024 / 1024:.1f}".replace(".", ","),
     }
 
 
-def _active_admin_count() -> int:
-    store = get_user_store()
-    return sum(1 for user in store.list_users() if user.active and user.role == Role.ADMIN)
+def _latest_apk_info() -> dict | None:
+    global _APK_INFO_CACHE  # noqa: PLW0603
+    apk_dir = Path(APK_DOWNLOAD_DIR)
+    try:
+        dir_stat = apk_dir.stat()
+    except OSError:
+        return None
+
+    # Adding, removing or renaming an APK changes the directory mtime; a swapped directory changes its inode.
+    cache_key = (str(apk_dir), dir_stat.st_dev, dir_stat.st_ino, dir_stat.st_mtime_ns)
+    cached = _APK_INFO_CACHE
+    if cached is not None and cached[0] == cache_key:
+        return cached[1]
+
+    info = _scan_latest_apk(apk_dir)
+    _APK_INFO_CACHE = (cache_key, info)
+    return info
+
+
+def _authenticate_login(username: str, password: str):
+    # Every attempt costs a username token; the shared address only pays for failed guesses,
+    # since all club terminals log in from the same address at shift start.
+    address_key = ("address", request.remote_addr or "")
+    wait_seconds = _LOGIN_THROTTLE.acquire([("username", username.strip().lower())], check_only=[address_key])
+    if wait_seconds:
+        raise APIError(
+            "Zu viele Anmeldeversuche, bitte spaeter erneut versuchen",
+            429,
+            headers={"Retry-After": str(math.ceil(wait_seconds))},
+        )
+    user = get_user_store().authenticate(username.strip(), password)
+    if not user:
+        _LOGIN_THROTTLE.penalize([address_key])
+    return user
 
 
 def _would_remove_last_active_admin(user, role: Role | None = None, active: bool | None = None) -> bool:
@@ -138,7 +255,7 @@ def _would_remove_last_active_admin(user, role: Role | None = None, active: bool
         return False
     if next_role == Role.ADMIN and next_active:
         return False
-    return _active_admin_count() <= 1
+    return get_user_store().count_active_admins() <= 1
 
 
 def _parse_price_cents_from_form(value: str | None) -> int:
@@ -162,6 +279,12 @@ def _stripe_obj_value(obj, key: str, default=None):
     return getattr(obj, key, default)
 
 
+def _stripe_id(obj) -> str | None:
+    if isinstance(obj, str):
+        return obj or None
+    return _stripe_obj_value(obj, "id") or None
+
+
 def _stripe_metadata_value(obj, key: str, default: str = "") -> str:
     metadata = _stripe_obj_value(obj, "metadata", {}) or {}
     if isinstance(metadata, dict):
@@ -200,9 +323,11 @@ def _stripe_payout_label(status: str | None) -> str:
     return labels.get(status or "", status or "Auszahlung unbekannt")
 
 
-def _latest_charge_for_intent(intent):
+def _latest_charge_for_intent(intent, stripe_objects: dict | None = None):
     charge = _stripe_obj_value(intent, "latest_charge")
     if isinstance(charge, str) and charge:
+        if stripe_objects is not None:
+            return stripe_objects.get(charge)
         return stripe.Charge.retrieve(charge)
     charges = _stripe_obj_value(intent, "charges")
     charge_data = _stripe_obj_value(charges, "data", []) if charges else []
@@ -211,13 +336,74 @@ def _latest_charge_for_intent(intent):
     return charge
 
 
-def _balance_transaction_for_charge(charge):
+def _charge_unresolved(intent, stripe_objects: dict) -> bool:
+    # A referenced charge that failed or missed the deadline; without it refund state is unknown.
+    charge = _stripe_obj_value(intent, "latest_charge")
+    return isinstance(charge, str) and bool(charge) and stripe_objects.get(charge) is None
+
+
+def _latest_charge_id(intent) -> str | None:
+    charge_id = _stripe_id(_stripe_obj_value(intent, "latest_charge"))
+    if charge_id:
+        return charge_id
+    charges = _stripe_obj_value(intent, "charges")
+    charge_data = _stripe_obj_value(charges, "data", []) if charges else []
+    return _stripe_id(charge_data[0]) if charge_data else None
+
+
+def _balance_transaction_for_charge(charge, stripe_objects: dict | None = None):
     balance_transaction = _stripe_obj_value(charge, "balance_transaction")
     if isinstance(balance_transaction, str) and balance_transaction:
+        if stripe_objects is not None:
+            return stripe_objects.get(balance_transaction)
         return stripe.BalanceTransaction.retrieve(balance_transaction)
     return balance_transaction
 
 
+def _retrieve_concurrently(object_ids, retrieve, deadline: float) -> dict:
+    object_ids = list(dict.fromkeys(object_id for object_id in object_ids if object_id))
+    if not object_ids:
+        return {}
+    retrieved = {}
+    futures = {_STRIPE_PREFETCH_EXECUTOR.submit(retrieve, object_id): object_id for object_id in object_ids}
+    done, not_done = wait(futures, timeout=max(deadline - time.monotonic(), 0))
+    for future in done:
+        try:
+            retrieved[futures[future]] = future.result()
+        except stripe.error.StripeError as err:
+            logger.warning("Could not retrieve Stripe object %s: %s", futures[future], err)
+    if not_done:
+        logger.warning("%s Stripe lookups missed the page deadline", len(not_done))
+        for future in not_done:
+            future.cancel()
+    return retrieved
+
+
+def _prefetch_unexpanded_stripe_objects(intents, payout_index: dict | None = None) -> dict:
+    deadline = time.monotonic() + STRIPE_PREFETCH_DEADLINE_SECONDS
+    stripe_objects = _retrieve_concurrently(
+        (
+            charge
+            for charge in (_stripe_obj_value(intent, "latest_charge") for intent in intents)
+            if isinstance(charge, str)
+        ),
+        stripe.Charge.retrieve,
+        deadline,
+    )
+    balance_transaction_ids = []
+    for intent in intents:
+        charge = _latest_charge_for_intent(intent, stripe_objects)
+        if _stripe_id(charge) in (payout_index or {}):
+            continue
+        balance_transaction = _stripe_obj_value(charge, "balance_transaction")
+        if isinstance(balance_transaction, str):
+            balance_transaction_ids.append(balance_transaction)
+    stripe_objects.update(
+        _retrieve_concurrently(balance_transaction_ids, stripe.BalanceTransaction.retrieve, deadline)
+    )
+    return stripe_objects
+
+
 def _payout_for_balance_transaction(balance_transaction, payout_cache: dict | None = None):
     payout = _stripe_obj_value(balance_transaction, "payout")
     if isinstance(payout, str) and payout:
@@ -230,20 +416,33 @@ def _payout_for_balance_transaction(balance_transaction, payout_cache: dict | No
     return payout
 
 
-def _payout_status_for_payment(charge, payout_cache: dict | None = None) -> tuple[str, str]:
-    balance_transaction = _balance_transaction_for_charge(charge)
+def _payout_label_and_detail(payout) -> tuple[str, str]:
+    status = _stripe_obj_value(payout, "status")
+    payout_id = _stripe_obj_value(payout, "id", "")
+    arrival_date = _format_stripe_date(_stripe_obj_value(payout, "arrival_date"))
+    detail = payout_id
+    if arrival_date != "-":
+        detail = f"{detail} / Ankunft {arrival_date}" if detail else f"Ankunft {arrival_date}"
+    return _stripe_payout_label(status), detail
+
+
+def _payout_status_for_payment(
+    charge,
+    payout_cache: dict | None = None,
+    payout_index: dict | None = None,
+    stripe_objects: dict | None = None,
+) -> tuple[str, str]:
+    indexed_payout = (payout_index or {}).get(_stripe_id(charge))
+    if indexed_payout:
+        return _payout_label_and_detail(indexed_payout)
+
+    balance_transaction = _balance_transaction_for_charge(charge, stripe_objects)
     if not balance_transaction:
         return "Auszahlung unbekannt", "keine Balance-Transaction"
 
     payout = _payout_for_balance_transaction(balance_transaction, payout_cache=payout_cache)
     if payout:
-        status = _stripe_obj_value(payout, "status")
-        payout_id = _stripe_obj_value(payout, "id", "")
-        arrival_date = _format_stripe_date(_stripe_obj_value(payout, "arrival_date"))
-        detail = payout_id
-        if arrival_date != "-":
-            detail = f"{detail} / Ankunft {arrival_date}" if detail else f"Ankunft {arrival_date}"
-        return _stripe_payout_label(status), detail
+        return _payout_label_and_detail(payout)
 
     balance_status = _stripe_obj_value(balance_transaction, "status")
     available_on = _format_stripe_date(_stripe_obj_value(balance_transaction, "available_on"))
@@ -258,8 +457,10 @@ def _payment_intent_to_admin_payment(
     intent,
     payout_cache: dict | None = None,
     include_payout_status: bool = True,
+    payout_index: dict | None = None,
+    stripe_objects: dict | None = None,
 ) -> dict:
-    charge = _latest_charge_for_intent(intent)
+    charge = _latest_charge_for_intent(intent, stripe_objects)
     amount_cents = int(_stripe_obj_value(charge, "amount", _stripe_obj_value(intent, "amount", 0)) or 0)
     amount_refunded_cents = int(_stripe_obj_value(charge, "amount_refunded", 0) or 0)
     refundable_cents = max(amount_cents - amount_refunded_cents, 0)
@@ -267,10 +468,20 @@ def _payment_intent_to_admin_payment(
     payout_label = "-"
     payout_detail = ""
     if include_payout_status:
-        payout_label, payout_detail = _payout_status_for_payment(charge, payout_cache=payout_cache)
+        payout_label, payout_detail = _payout_status_for_payment(
+            charge,
+            payout_cache=payout_cache,
+            payout_index=payout_index,
+            stripe_objects=stripe_objects,
+        )
 
+    balance_transaction = _stripe_obj_value(charge, "balance_transaction")
+    payout_id = None
+    if balance_transaction is not None and not isinstance(balance_transaction, str):
+        payout_id = _stripe_id(_stripe_obj_value(balance_transaction, "payout"))
     return {
         "id": _stripe_obj_value(intent, "id", ""),
+        "created": int(_stripe_obj_value(intent, "created", 0) or 0),
         "created_label": _format_stripe_timestamp(_stripe_obj_value(intent, "created")),
         "item": _stripe_metadata_value(intent, "item", "-"),
         "cashier": _stripe_metadata_value(intent, "kassierer", "-"),
@@ -283,26 +494,266 @@ def _payment_intent_to_admin_payment(
         "receipt_url": _stripe_obj_value(charge, "receipt_url"),
         "charge_id": _stripe_obj_value(charge, "id", ""),
         "refunded": bool(_stripe_obj_value(charge, "refunded", False)) or refundable_cents == 0,
+        "balance_transaction_id": _stripe_id(balance_transaction),
+        "payout_id": payout_id,
         "payout_label": payout_label,
         "payout_detail": payout_detail,
+        "details_unavailable": False,
     }
 
 
+def _unresolved_admin_payment(intent) -> dict:
+    # The charge could not be fetched in time: show the payment, but not as refundable or unrefunded.
+    payment = _payment_intent_to_admin_payment(intent, include_payout_status=False, stripe_objects={})
+    payment.update({
+        "charge_id": _latest_charge_id(intent) or "",
+        "refundable_cents": 0,
+        "payout_label": "Status unbekannt",
+        "payout_detail": "Charge konnte nicht von Stripe geladen werden",
+        "details_unavailable": True,
+    })
+    return payment
+
+
+def _is_club_payment(intent) -> bool:
+    club = _stripe_metadata_value(intent, "club")
+    return not club or club == CLUB_NAME
+
+
+def _ledger_payment_to_admin_payment(payment) -> dict:
+    return {
+        "id": payment.id,
+        "created": payment.created,
+        "created_label": _format_stripe_timestamp(payment.created),
+        "item": payment.item,
+        "cashier": payment.cashier,
+        "device": payment.device,
+        "amount_cents": payment.amount_cents,
+        "amount_refunded_cents": payment.amount_refunded_cents,
+        "refundable_cents": payment.refundable_cents,
+        "currency": payment.currency,
+        "status": payment.status,
+        "receipt_url": payment.receipt_url,
+        "charge_id": payment.charge_id or "",
+        "refunded": payment.refunded or payment.refundable_cents == 0,
+        "balance_transaction_id": payment.balance_transaction_id,
+        "payout_id": payment.payout_id,
+        "payout_label": payment.payout_label,
+        "payout_detail": payment.payout_detail,
+        "details_unavailable": False,
+    }
+
+
+def _payment_ledger_enabled() -> bool:
+    return bool(WEBHOOK_SECRET)
+
+
+def _store_intent_in_ledger(intent, payout_cache: dict | None = None) -> dict:
+    payment = _payment_intent_to_admin_payment(intent, payout_cache=payout_cache)
+    get_payment_store().upsert_payment(payment["id"], payment)
+    return payment
+
+
+def _ledger_payment_changed(existing, payment: dict) -> bool:
+    if existing is None:
+        return True
+    return any(
+        getattr(existing, key) != payment[key]
+        for key in ("status", "amount_cents", "amount_refunded_cents", "refunded", "receipt_url", "charge_id")
+    )
+
+
+def _sync_payments_from_stripe(full: bool = False) -> int:
+    with _PAYMENT_SYNC_LOCK:
+        state = get_app_state_store()
+        ledger = get_payment_store()
+        if full:
+            for key in (
+                PAYMENT_SYNC_HIGH_WATER_KEY,
+                PAYMENT_SYNC_CURSOR_KEY,
+                PAYMENT_SYNC_RUN_MAX_KEY,
+                PAYMENT_SYNC_RETRY_FROM_KEY,
+            ):
+                state.set(key, None)
+
+        high_water = int(state.get(PAYMENT_SYNC_HIGH_WATER_KEY) or 0)
+        starting_after = state.get(PAYMENT_SYNC_CURSOR_KEY)
+        run_max = int(state.get(PAYMENT_SYNC_RUN_MAX_KEY) or high_water)
+        retry_from = int(state.get(PAYMENT_SYNC_RETRY_FROM_KEY) or 0)
+        created_from = max(high_water - PAYMENT_SYNC_LOOKBACK_SECONDS, 0) if high_water else 0
+        payout_cache = {}
+        synced = 0
+
+        while True:
+            params = {"limit": 100, "expand": STRIPE_PAYMENT_INTENT_EXPAND}
+            if created_from:
+                params["created"] = {"gte": created_from}
+            if starting_after:
+                params["starting_after"] = starting_after
+            page = stripe.PaymentIntent.list(**params)
+            intents = list(_stripe_obj_value(page, "data", []) or [])
+            existing = ledger.get_payments(_stripe_obj_value(intent, "id", "") for intent in intents)
+            run_max = max([run_max, *(int(_stripe_obj_value(intent, "created", 0) or 0) for intent in intents)])
+            club_intents = [
+                intent
+                for intent in intents
+                if _stripe_obj_value(intent, "status") == "succeeded" and _is_club_payment(intent)
+            ]
+            payout_index = ledger.payouts_for_charges(_latest_charge_id(intent) for intent in club_intents)
+            stripe_objects = _prefetch_unexpanded_stripe_objects(club_intents, payout_index)
+            for intent in club_intents:
+                if _charge_unresolved(intent, stripe_objects):
+                    # Leave the stored row alone and make the next run revisit this intent.
+                    created = int(_stripe_obj_value(intent, "created", 0) or 0)
+                    retry_from = min(retry_from, created) if retry_from else created
+                    continue
+                payment = _payment_intent_to_admin_payment(
+                    intent,
+                    include_payout_status=False,
+                    stripe_objects=stripe_objects,
+                )
+                if not _ledger_payment_changed(existing.get(payment["id"]), payment):
+                    continue
+                payment["payout_label"], payment["payout_detail"] = _payout_status_for_payment(
+                    _latest_charge_for_intent(intent, stripe_objects),
+                    payout_cache=payout_cache,
+                    payout_index=payout_index,
+                    stripe_objects=stripe_objects,
+                )
+                ledger.upsert_payment(payment["id"], payment)
+                synced += 1
+
+            if not intents or not _stripe_obj_value(page, "has_more", False):
+                break
+            starting_after = _stripe_obj_value(intents[-1], "id")
+            state.set(PAYMENT_SYNC_CURSOR_KEY, starting_after)
+            state.set(PAYMENT_SYNC_RUN_MAX_KEY, str(run_max))
+            state.set(PAYMENT_SYNC_RETRY_FROM_KEY, str(retry_from) if retry_from else None)
+
+        state.set(PAYMENT_SYNC_HIGH_WATER_KEY, str(min(run_max, retry_from) if retry_from else run_max))
+        state.set(PAYMENT_SYNC_CURSOR_KEY, None)
+        state.set(PAYMENT_SYNC_RUN_MAX_KEY, None)
+        state.set(PAYMENT_SYNC_RETRY_FROM_KEY, None)
+        return synced
+
+
+def _index_payout(payout, known_payout=None) -> None:
+    payout_id = _stripe_id(payout)
+    if not payout_id:
+        return
+    charge_ids = None
+    if known_payout is None or not known_payout.charges_indexed:
+        balance_transactions = stripe.BalanceTransaction.list(payout=payout_id, type="charge", limit=100)
+        charge_ids = [
+            _stripe_id(_stripe_obj_value(balance_transaction, "source"))
+            for balance_transaction in balance_transactions.auto_paging_iter()
+        ]
+    ledger = get_payment_store()
+    ledger.store_payout(
+        payout_id,
+        status=_stripe_obj_value(payout, "status"),
+        arrival_date=_stripe_obj_value(payout, "arrival_date"),
+        charge_ids=charge_ids,
+    )
+    if _payment_ledger_enabled():
+        payout_label, payout_detail = _payout_label_and_detail(payout)
+        ledger.update_payout_status(payout_id, payout_label, payout_detail, charge_ids=charge_ids or ())
+
+
+def _reconcile_payouts(force: bool = False) -> int:
+    if PAYOUT_RECONCILE_INTERVAL_SECONDS <= 0 and not force:
+        return 0
+    state = get_app_state_store()
+    now = int(time.time())
+    reconciled_at = int(state.get(PAYOUT_RECONCILED_AT_KEY) or 0)
+    if not force and now - reconciled_at < PAYOUT_RECONCILE_INTERVAL_SECONDS:
+        return 0
+
+    payouts = list(_stripe_obj_value(stripe.Payout.list(limit=PAYOUT_RECONCILE_LIMIT), "data", []) or [])
+    known_payouts = get_payment_store().get_payouts(_stripe_id(payout) for payout in payouts)
+    indexed = 0
+    for payout in payouts:
+        known_payout = known_payouts.get(_stripe_id(payout))
+        if (
+            known_payout
+            and known_payout.charges_indexed
+            and known_payout.status == _stripe_obj_value(payout, "status")
+        ):
+            continue
+        _index_payout(payout, known_payout=known_payout)
+        indexed += 1
+    state.set(PAYOUT_RECONCILED_AT_KEY, str(now))
+    return indexed
+
+
+def _reconcile_payouts_safely() -> None:
+    try:
+        _reconcile_payouts()
+    except stripe.error.StripeError as err:
+        logger.warning("Payout reconciliation failed: %s", err)
+
+
+def _run_payment_sync_job() -> None:
+    while True:
+        try:
+            # A fresh app context per round gives each sync its own session, closed on teardown.
+            with app.app_context():
+                synced = _sync_payments_from_stripe()
+                indexed_payouts = _reconcile_payouts()
+            if synced or indexed_payouts:
+                logger.info("Payment sync stored %s payments and indexed %s payouts", synced, indexed_payouts)
+                _ADMIN_PAYMENTS_CACHE.invalidate()
+        except stripe.error.StripeError as err:
+            logger.warning("Payment sync failed: %s", err)
+        except Exception:  # noqa: BLE001
+            logger.exception("Payment sync crashed")
+        time.sleep(PAYMENT_SYNC_INTERVAL_SECONDS)
+
+
+def _start_payment_sync_job() -> None:
+    if PAYMENT_SYNC_INTERVAL_SECONDS <= 0 or not _payment_ledger_enabled():
+        return
+    threading.Thread(target=_run_payment_sync_job, name="payment-sync", daemon=True).start()
+
+
 def _list_successful_admin_payments() -> list[dict]:
+    if not _payment_ledger_enabled():
+        return _list_successful_admin_payments_from_stripe()
+    # Webhooks write single rows long before the history is there; trust the ledger only once a
+    # backfill (the sync job or `flask sync-payments`) has completed and set its high-water mark.
+    if not get_app_state_store().get(PAYMENT_SYNC_HIGH_WATER_KEY):
+        return _list_successful_admin_payments_from_stripe()
+    ledger = get_payment_store()
+    return [_ledger_payment_to_admin_payment(payment) for payment in ledger.list_successful_payments()]
+
+
+def _list_successful_admin_payments_from_stripe() -> list[dict]:
     intents = stripe.PaymentIntent.list(
         limit=100,
-        expand=["data.latest_charge", "data.latest_charge.balance_transaction"],
+        expand=STRIPE_PAYMENT_INTENT_EXPAND,
     )
-    payments = []
+    intents = [
+        intent
+        for intent in _stripe_obj_value(intents, "data", []) or []
+        if _stripe_obj_value(intent, "status") == "succeeded" and _is_club_payment(intent)
+    ]
+    _reconcile_payouts_safely()
+    payout_index = get_payment_store().payouts_for_charges(
+        _latest_charge_id(intent) for intent in intents
+    )
+    stripe_objects = _prefetch_unexpanded_stripe_objects(intents, payout_index)
     payout_cache = {}
-    for intent in _stripe_obj_value(intents, "data", []) or []:
-        if _stripe_obj_value(intent, "status") != "succeeded":
-            continue
-        club = _stripe_metadata_value(intent, "club")
-        if club and club != "DARC e.V. OV L11":
-            continue
-        payments.append(_payment_intent_to_admin_payment(intent, payout_cache=payout_cache))
-    return payments
+    return [
+        _unresolved_admin_payment(intent)
+        if _charge_unresolved(intent, stripe_objects)
+        else _payment_intent_to_admin_payment(
+            intent,
+            payout_cache=payout_cache,
+            payout_index=payout_index,
+            stripe_objects=stripe_objects,
+        )
+        for intent in intents
+    ]
 
 
 def _parse_optional_refund_cents(value: str | None) -> int | None:
@@ -311,14 +762,23 @@ def _parse_optional_refund_cents(value: str | None) -> int | None:
     return _parse_price_cents_from_form(value)
 
 
+def _refundable_payment(payment_intent_id: str) -> dict:
+    if _payment_ledger_enabled():
+        ledger_payment = get_payment_store().get_payment(payment_intent_id)
+        if ledger_payment and ledger_payment.status == "succeeded":
+            return _ledger_payment_to_admin_payment(ledger_payment)
+
+    intent = stripe.PaymentIntent.retrieve(payment_intent_id, expand=["latest_charge"])
+    if _stripe_obj_value(intent, "status") != "succeeded":
+        raise APIError("Nur erfolgreiche Zahlungen koennen erstattet werden", 400)
+    return _payment_intent_to_admin_payment(intent, include_payout_status=False)
+
+
 def _refund_payment_intent(payment_intent_id: str | None, refund_amount: str | None) -> int:
     if not isinstance(payment_intent_id, str) or not payment_intent_id.strip():
         raise APIError("payment_intent_id ist erforderlich", 400)
-    intent = stripe.PaymentIntent.retrieve(payment_intent_id.strip(), expand=["latest_charge"])
-    if _stripe_obj_value(intent, "status") != "succeeded":
-        raise APIError("Nur erfolgreiche Zahlungen koennen erstattet werden", 400)
 
-    payment = _payment_intent_to_admin_payment(intent, include_payout_status=False)
+    payment = _refundable_payment(payment_intent_id.strip())
     refundable_cents = payment["refundable_cents"]
     if refundable_cents <= 0:
         raise APIError("Diese Zahlung ist bereits voll erstattet", 400)
@@ -327,20 +787,79 @@ def _refund_payment_intent(payment_intent_id: str | None, refund_amount: str | N
     if requested_cents > refundable_cents:
         raise APIError("Rueckerstattung darf den offenen Betrag nicht ueberschreiten", 400)
 
-    stripe.Refund.create(
+    refund = stripe.Refund.create(
         payment_intent=payment["id"],
         amount=requested_cents,
         reason="requested_by_customer",
         metadata={"refunded_by": "club-payment-admin"},
     )
+    if _payment_ledger_enabled():
+        _record_refund_from_stripe(refund)
+    _ADMIN_PAYMENTS_CACHE.invalidate()
     return requested_cents
 
 
-def _resolve_terminal_location_id() -> str:
-    configured_location_id = (STRIPE_LOCATION_ID or "").strip()
-    if configured_location_id:
-        return configured_location_id
+def _record_refund_from_stripe(refund) -> None:
+    # Store Stripe's absolute refunded amount; the charge.refunded webhook may already have landed.
+    charge_id = _stripe_id(_stripe_obj_value(refund, "charge"))
+    if not charge_id:
+        return
+    try:
+        charge = stripe.Charge.retrieve(charge_id)
+    except stripe.error.StripeError as err:
+        logger.warning("Could not refresh refunded charge %s: %s", charge_id, err)
+        return
+    _handle_charge_event(charge)
+
+
+def _handle_payment_intent_event(intent) -> None:
+    if _stripe_obj_value(intent, "status") != "succeeded" or not _is_club_payment(intent):
+        return
+    _store_intent_in_ledger(intent)
+
+
+def _handle_charge_event(charge) -> None:
+    payment_intent_id = _stripe_id(_stripe_obj_value(charge, "payment_intent"))
+    if not payment_intent_id:
+        return
+    amount_cents = int(_stripe_obj_value(charge, "amount", 0) or 0)
+    amount_refunded_cents = int(_stripe_obj_value(charge, "amount_refunded", 0) or 0)
+    updated = get_payment_store().update_payment(payment_intent_id, {
+        "amount_cents": amount_cents,
+        "amount_refunded_cents": amount_refunded_cents,
+        "refunded": bool(_stripe_obj_value(charge, "refunded", False)) or amount_refunded_cents >= amount_cents,
+        "receipt_url": _stripe_obj_value(charge, "receipt_url"),
+        "charge_id": _stripe_id(charge),
+        "balance_transaction_id": _stripe_id(_stripe_obj_value(charge, "balance_transaction")),
+    })
+    if updated is None:
+        intent = stripe.PaymentIntent.retrieve(payment_intent_id, expand=["latest_charge"])
+        _handle_payment_intent_event(intent)
+
+
+def _handle_payout_event(payout) -> None:
+    known_payout = get_payment_store().get_payouts([_stripe_id(payout)]).get(_stripe_id(payout))
+    _index_payout(payout, known_payout=known_payout)
+
 
+_LEDGER_EVENT_HANDLERS = {
+    "payment_intent.succeeded": _handle_payment_intent_event,
+    "charge.refunded": _handle_charge_event,
+    "charge.updated": _handle_charge_event,
+}
+
+
+def _apply_event_to_ledger(event) -> None:
+    event_type = event["type"]
+    handler = _LEDGER_EVENT_HANDLERS.get(event_type)
+    if handler is None and event_type.startswith("payout."):
+        handler = _handle_payout_event
+    if handler is not None:
+        handler(event["data"]["object"])
+        _ADMIN_PAYMENTS_CACHE.invalidate()
+
+
+def _lookup_terminal_location_id() -> str:
     try:
         locations = stripe.terminal.Location.list(limit=100)
         for location in getattr(locations, "data", None) or []:
@@ -366,27 +885,59 @@ def _resolve_terminal_location_id() -> str:
     )
 
 
+def _resolve_terminal_location_id(refresh: bool = False) -> str:
+    global _TERMINAL_LOCATION_ID  # noqa: PLW0603
+    configured_location_id = (STRIPE_LOCATION_ID or "").strip()
+    if configured_location_id:
+        return configured_location_id
+    if _TERMINAL_LOCATION_ID and not refresh:
+        return _TERMINAL_LOCATION_ID
+
+    with _TERMINAL_LOCATION_LOCK:
+        if _TERMINAL_LOCATION_ID and not refresh:
+            return _TERMINAL_LOCATION_ID
+        state = get_app_state_store()
+        location_id = None if refresh else state.get(TERMINAL_LOCATION_STATE_KEY)
+        if not location_id:
+            location_id = _lookup_terminal_location_id()
+            state.set(TERMINAL_LOCATION_STATE_KEY, location_id)
+        _TERMINAL_LOCATION_ID = location_id
+        return location_id
+
+
+def _parse_pending_cursor(value: str | None):
+    if not value or "|" not in value:
+        return None
+    last_seen_at, device_id = value.split("|", 1)
+    try:
+        return datetime.fromisoformat(last_seen_at), device_id
+    except ValueError:
+        return None
+
+
+def _format_pending_cursor(cursor) -> str | None:
+    if cursor is None:
+        return None
+    last_seen_at, device_id = cursor
+    return f"{last_seen_at.isoformat()}|{device_id}"
+
+
 def _render_admin_users(admin_user, error_message: str | None = None):
-    store = get_user_store()
-    users = list(store.list_users())
-    registry = get_device_registry()
-    assignments = {assignment.user_id: assignment.device_id for assignment in registry.list_devices()}
-    devices = []
-    for assignment in registry.list_devices():
-        user = store.get_by_id(assignment.user_id)
-        devices.append({
-            "device_id": assignment.device_id,
-            "user": user,
-        })
-    pending_devices = list(registry.list_pending_devices())
+    overview = get_device_registry().admin_overview(
+        pending_limit=ADMIN_PENDING_DEVICES_PAGE_SIZE,
+        pending_after=_parse_pending_cursor(request.args.get("pending_after")),
+    )
+    assignments = {device.user_id: device.device_id for device in overview.devices}
     return render_template(
         "admin_users.html",
         admin_name=_user_identifier(admin_user),
         is_admin=_is_admin(admin_user),
-        users=users,
+        users=overview.users,
         assignments=assignments,
-        devices=devices,
-        pending_devices=pending_devices,
+        devices=overview.devices,
+        pending_devices=overview.pending.devices,
+        pending_total=overview.pending.total,
+        pending_next=_format_pending_cursor(overview.pending.next_cursor),
         user_identifier=_user_identifier,
         error_message=error_message,
     )
@@ -404,14 +955,36 @@ def _render_admin_products(admin_user, error_message: str | None = None):
     )
 
 
+def _log_admin_payments_refresh_error(err: Exception) -> None:
+    logger.warning("Background refresh of admin payments failed: %s", err)
+
+
+_ADMIN_PAYMENTS_CACHE = StaleWhileRevalidateCache(
+    loader=lambda: _list_successful_admin_payments(),
+    ttl_seconds=ADMIN_PAYMENTS_CACHE_TTL_SECONDS,
+    on_refresh_error=_log_admin_payments_refresh_error,
+)
+
+
+def _format_data_age(loaded_at: float) -> str:
+    age_seconds = max(int(time.time() - loaded_at), 0)
+    if age_seconds < 5:
+        return "gerade eben"
+    if age_seconds < 120:
+        return f"vor {age_seconds} Sekunden"
+    return f"vor {age_seconds // 60} Minuten"
+
+
 def _render_admin_payments(
     admin_user,
     error_message: str | None = None,
     success_message: str | None = None,
 ):
     payments = []
+    payments_age = None
     try:
-        payments = _list_successful_admin_payments()
+        payments, loaded_at = _ADMIN_PAYMENTS_CACHE.get()
+        payments_age = _format_data_age(loaded_at)
     except stripe.error.StripeError as err:
         logger.warning("Could not load Stripe payments for admin page: %s", err)
         error_message = error_message or "Zahlungen konnten nicht von Stripe geladen werden"
@@ -422,6 +995,8 @@ def _render_admin_payments(
         is_admin=_is_admin(admin_user),
         can_refund=_is_admin(admin_user),
         payments=payments,
+        payments_age=payments_age,
+        unavailable_payments=sum(1 for payment in payments if payment["details_unavailable"]),
         format_price_euros=_format_price_euros,
         error_message=error_message,
         success_message=success_message,
@@ -438,11 +1013,20 @@ def download_latest_apk():
     apk = _latest_apk_info()
     if not apk:
         return "Keine APK verfuegbar", 404
+    try:
+        apk_stat = apk["path"].stat()
+    except FileNotFoundError:
+        return "Keine APK verfuegbar", 404
+    # Stat freshly so an APK overwritten in place never reuses the validator of the old bytes,
+    # which would let If-Range splice ranges of two different builds.
     return send_file(
         apk["path"],
         as_attachment=True,
         download_name=apk["filename"],
         mimetype="application/vnd.android.package-archive",
+        conditional=True,
+        etag=f"{apk_stat.st_mtime_ns:x}-{apk_stat.st_size:x}",
+        last_modified=apk_stat.st_mtime,
     )
 
 
@@ -450,14 +1034,19 @@ def download_latest_apk():
 def latest_app_version():
     apk = _latest_apk_info()
     if not apk:
-        return jsonify({"available": False})
-    return jsonify({
-        "available": True,
-        "version": apk["version"],
-        "filename": apk["filename"],
-        "size_mb": apk["size_mb"],
-        "download_path": url_for("download_latest_apk"),
-    })
+        response = jsonify({"available": False})
+    else:
+        response = jsonify({
+            "available": True,
+            "version": apk["version"],
+            "filename": apk["filename"],
+            "size_mb": apk["size_mb"],
+            "download_path": url_for("download_latest_apk"),
+        })
+        response.last_modified = apk["modified_at"]
+    response.add_etag()
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 
 @app.route("/terminal/connection_token", methods=["POST"])
@@ -475,6 +1064,13 @@ def terminal_config():
     return jsonify({"location_id": _resolve_terminal_location_id()})
 
 
+@app.route("/terminal/config/refresh", methods=["POST"])
+@handle_errors
+def refresh_terminal_config():
+    authenticate_request(request, require_admin=True)
+    return jsonify({"location_id": _resolve_terminal_location_id(refresh=True)})
+
+
 @app.route("/pos/create_intent", methods=["POST"])
 @handle_errors
 def create_payment_intent():
@@ -503,7 +1099,7 @@ def create_payment_intent():
 
     description = "DARC e.V. OV L11 Getränke"
     metadata = {
-        "club": "DARC e.V. OV L11",
+        "club": CLUB_NAME,
         "item": str(item),
         "kassierer": str(kassierer),
         "device": str(device),
@@ -576,23 +1172,62 @@ def assign_device():
     }), 201
 
 
+def _parse_device_page_limit(value: str | None) -> int | None:
+    if value is None:
+        return None
+    try:
+        limit = int(value)
+    except ValueError:
+        raise APIError("limit muss eine Zahl sein", 400)
+    if limit < 1 or limit > ADMIN_DEVICES_MAX_PAGE_SIZE:
+        raise APIError(f"limit muss zwischen 1 und {ADMIN_DEVICES_MAX_PAGE_SIZE} liegen", 400)
+    return limit
+
+
+def _parse_device_fields(value: str | None) -> list[str] | None:
+    if value is None:
+        return None
+    fields = [field.strip() for field in value.split(",") if field.strip()]
+    unknown = [field for field in fields if field not in ADMIN_DEVICE_FIELDS]
+    if not fields or unknown:
+        raise APIError(f"fields erlaubt nur: {', '.join(ADMIN_DEVICE_FIELDS)}", 400)
+    return fields
+
+
+def _admin_device_payload(device, fields: list[str] | None = None) -> dict:
+    user = device.user
+    payload = {
+        "device_id": device.device_id,
+        "user_id": device.user_id,
+        "name": _user_identifier(user) if user else None,
+        "username": user.username if user else None,
+        "role": user.role.value if user else None,
+        "active": user.active if user else None,
+    }
+    if fields is None:
+        return payload
+    return {field: payload[field] for field in fields}
+
+
 @app.route("/admin/devices", methods=["GET"])
 @handle_errors
 def list_devices():
     authenticate_request(request, require_admin=True)
     registry = get_device_registry()
-    store = get_user_store()
-    devices = []
-    for assignment in registry.list_devices():
-        user = store.get_by_id(assignment.user_id)
-        devices.append({
-            "device_id": assignment.device_id,
-            "user_id": assignment.user_id,
-            "name": _user_identifier(user) if user else None,
-            "username": user.username if user else None,
-            "role": user.role.value if user else None,
-            "active": user.active if user else None,
+    limit = _parse_device_page_limit(request.args.get("limit"))
+    after = request.args.get("after")
+    fields = _parse_device_fields(request.args.get("fields"))
+
+    if limit is not None or after is not None:
+        page_size = limit or ADMIN_DEVICES_MAX_PAGE_SIZE
+        assigned = registry.list_devices_with_users(limit=page_size + 1, after=after)
+        next_after = assigned[page_size - 1].device_id if len(assigned) > page_size else None
+        return jsonify({
+            "devices": [_admin_device_payload(device, fields) for device in assigned[:page_size]],
+            "next_after": next_after,
         })
+
+    devices = [_admin_device_payload(device, fields) for device in registry.list_devices_with_users()]
     pending_devices = [
         {
             "device_id": pending.device_id,
@@ -670,8 +1305,7 @@ def login():
     if not isinstance(password, str) or not password.strip():
         raise APIError("password ist erforderlich", 400)
 
-    store = get_user_store()
-    user = store.authenticate(username.strip(), password)
+    user = _authenticate_login(username, password)
     if not user:
         raise APIError("Benutzername oder Passwort ungültig", 401)
     if not user.active:
@@ -680,12 +1314,11 @@ def login():
     device_pending = False
     if isinstance(device_id, str) and device_id.strip():
         registry = get_device_registry()
-        pending_device = registry.remember_pending_device(
+        device_pending = registry.touch_pending_device(
             device_id=device_id.strip(),
             user_id=user.id,
             username=_user_identifier(user),
         )
-        device_pending = pending_device is not None
 
     return jsonify({
         "token": user.api_token,
@@ -710,8 +1343,10 @@ def admin_web_login():
         elif not isinstance(password, str) or not password.strip():
             error_message = "password ist erforderlich"
         else:
-            store = get_user_store()
-            user = store.authenticate(username.strip(), password)
+            try:
+                user = _authenticate_login(username, password)
+            except APIError as err:
+                return render_template("admin_login.html", error_message=str(err)), err.status_code, err.headers
             if not user:
                 error_message = "Benutzername oder Passwort ungültig"
             elif not user.active:
@@ -719,6 +1354,8 @@ def admin_web_login():
             elif user.role not in {Role.ADMIN, Role.KASSIERER}:
                 error_message = "Nur Admins und Kassierer duerfen sich anmelden"
             else:
+                # The first page load validates the user again and stamps the snapshot.
+                _forget_web_user()
                 session["admin_user_id"] = user.id
                 return redirect(url_for(_default_web_endpoint_for_user(user)))
 
@@ -727,7 +1364,7 @@ def admin_web_login():
 
 @app.route("/admin/web/logout", methods=["POST"])
 def admin_web_logout():
-    session.pop("admin_user_id", None)
+    _forget_web_user()
     return redirect(url_for("admin_web_login"))
 
 
@@ -739,6 +1376,7 @@ def admin_web_account():
 
     error_message = None
     success_message = None
+    status_code, headers = 200, {}
     if request.method == "POST":
         current_password = request.form.get("current_password")
         new_password = request.form.get("new_password")
@@ -756,18 +1394,22 @@ def admin_web_account():
             error_message = "Dieser Nutzer hat keinen Benutzernamen"
         else:
             store = get_user_store()
-            if not store.authenticate(web_user.username, current_password):
-                error_message = "Aktuelles Passwort ist falsch"
-            else:
-                updated = store.update_user(
-                    user_id=web_user.id,
-                    password_hash=store.hash_password(new_password.strip()),
-                )
-                if not updated:
-                    error_message = "Nutzer konnte nicht aktualisiert werden"
+            try:
+                if not _authenticate_login(web_user.username, current_password):
+                    error_message = "Aktuelles Passwort ist falsch"
                 else:
-                    web_user = updated
-                    success_message = "Passwort wurde aktualisiert"
+                    updated = store.update_user(
+                        user_id=web_user.id,
+                        password_hash=store.hash_password(new_password.strip()),
+                    )
+                    if not updated:
+                        error_message = "Nutzer konnte nicht aktualisiert werden"
+                    else:
+                        web_user = updated
+                        success_message = "Passwort wurde aktualisiert"
+            except APIError as err:
+                error_message = str(err)
+                status_code, headers = err.status_code, err.headers
 
     return render_template(
         "admin_account.html",
@@ -776,7 +1418,7 @@ def admin_web_account():
         is_admin=_is_admin(web_user),
         error_message=error_message,
         success_message=success_message,
-    )
+    ), status_code, headers
 
 
 @app.route("/admin/web")
@@ -817,9 +1459,11 @@ def admin_web_users():
                     raise APIError("Der eigene Admin-Nutzer kann hier nicht geloescht werden", 400)
                 if _would_remove_last_active_admin(user, active=False):
                     raise APIError("Der letzte aktive Admin kann nicht geloescht werden", 400)
-                registry = get_device_registry()
-                registry.delete_devices_for_user(user.id)
-                store.delete_user(user.id)
+                try:
+                    store.delete_user(user.id, delete_devices=True, keep_active_admin=True)
+                except LastActiveAdminError:
+                    raise APIError("Der letzte aktive Admin kann nicht geloescht werden", 400)
+                get_device_registry().discard_pending_heartbeats_for_user(user.id)
                 return redirect(url_for("admin_web_users"))
 
             if role_value not in {Role.ADMIN.value, Role.KASSIERER.value}:
@@ -857,14 +1501,18 @@ def admin_web_users():
                 if _would_remove_last_active_admin(user, role=role, active=active):
                     raise APIError("Der letzte aktive Admin muss aktiv bleiben", 400)
                 password_hash = store.hash_password(password) if isinstance(password, str) and password.strip() else None
-                store.update_user(
-                    user_id=user.id,
-                    name=normalized_username,
-                    role=role,
-                    active=active,
-                    username=normalized_username,
-                    password_hash=password_hash,
-                )
+                try:
+                    store.update_user(
+                        user_id=user.id,
+                        name=normalized_username,
+                        role=role,
+                        active=active,
+                        username=normalized_username,
+                        password_hash=password_hash,
+                        keep_active_admin=True,
+                    )
+                except LastActiveAdminError:
+                    raise APIError("Der letzte aktive Admin muss aktiv bleiben", 400)
                 return redirect(url_for("admin_web_users"))
 
             raise APIError("Unbekannte Aktion", 400)
@@ -1055,14 +1703,20 @@ def update_user(user_id: int):
             raise APIError("username ist bereits vergeben", 400)
     if _would_remove_last_active_admin(current_user, role=role, active=active):
         raise APIError("Der letzte aktive Admin muss aktiv bleiben", 400)
-    user = store.update_user(
-        user_id=user_id,
-        name=normalized_username,
-        role=role,
-        active=active,
-        username=normalized_username,
-        password_hash=store.hash_password(password) if isinstance(password, str) else None,
-    )
+    try:
+        user = store.update_user(
+            user_id=user_id,
+            name=normalized_username,
+            role=role,
+            active=active,
+            username=normalized_username,
+            password_hash=store.hash_password(password) if isinstance(password, str) else None,
+            keep_active_admin=True,
+        )
+    except LastActiveAdminError:
+        raise APIError("Der letzte aktive Admin muss aktiv bleiben", 400)
+    if not user:
+        raise APIError("User nicht gefunden", 404)
     return jsonify({
         "id": user.id,
         "name": _user_identifier(user),
@@ -1085,12 +1739,27 @@ def delete_user(user_id: int):
     if _would_remove_last_active_admin(user, active=False):
         raise APIError("Der letzte aktive Admin kann nicht geloescht werden", 400)
 
-    registry = get_device_registry()
-    registry.delete_devices_for_user(user.id)
-    store.delete_user(user.id)
+    try:
+        store.delete_user(user.id, delete_devices=True, keep_active_admin=True)
+    except LastActiveAdminError:
+        raise APIError("Der letzte aktive Admin kann nicht geloescht werden", 400)
+    get_device_registry().discard_pending_heartbeats_for_user(user.id)
     return jsonify({"deleted": True, "id": user_id})
 
 
+@app.route("/admin/stats", methods=["GET"])
+@handle_errors
+def admin_stats():
+    authenticate_request(request, require_admin=True)
+    store = get_user_store()
+    return jsonify({
+        "token_cache": store.token_cache_stats(),
+        "unknown_token_cache": store.unknown_token_cache_stats(),
+        "password_hashing": get_password_hash_executor().stats(),
+        "login_throttle": _LOGIN_THROTTLE.stats(),
+    })
+
+
 @app.route("/admin/products", methods=["POST"])
 @handle_errors
 def create_product():
@@ -1218,9 +1887,34 @@ def webhook():
     logger.info("Received event: %s", event["type"])
     with open("payments.log", "a", encoding="utf-8") as log_file:
         log_file.write(f"{event['id']} - {event['type']} - {event['created']}\n")
+    _apply_event_to_ledger(event)
 
     return jsonify({"status": "received"})
 
 
+@app.cli.command("sync-payments")
+@click.option("--full", is_flag=True, help="Ignore the stored high-water mark and re-read the whole history.")
+def sync_payments_command(full: bool) -> None:
+    synced = _sync_payments_from_stripe(full=full)
+    click.echo(f"{synced} Zahlungen synchronisiert")
+
+
+@app.cli.command("calibrate-password-hash")
+@click.option("--target-ms", type=float, default=250.0, show_default=True, help="Desired verify time per login.")
+@click.option("--algorithm", type=click.Choice(["scrypt", "pbkdf2"]), default="scrypt", show_default=True)
+def calibrate_password_hash_command(target_ms: float, algorithm: str) -> None:
+    click.echo(f"PASSWORD_HASH_METHOD={calibrate_method(target_ms, algorithm)}")
+
+
+@app.cli.command("run-payment-sync")
+def run_payment_sync_command() -> None:
+    if PAYMENT_SYNC_INTERVAL_SECONDS <= 0 or not _payment_ledger_enabled():
+        raise click.ClickException("PAYMENT_SYNC_INTERVAL_SECONDS und STRIPE_WEBHOOK_SECRET muessen gesetzt sein")
+    _run_payment_sync_job()
+
+
 if __name__ == "__main__":
+    # The debug reloader runs this block in a watcher and a serving process; sync only in the latter.
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        _start_payment_sync_job()
     app.run(host="0.0.0.0", port=int(os.getenv("PORT", 4040)), debug=True)
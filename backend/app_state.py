@@ -0,0 +1,39 @@
+from __future__ import annotations
+
+from datetime import datetime, timezone
+from typing import Optional
+
+from database import AppStateRecord, init_database, session_scope
+
+
+class AppStateStore:
+    def get(self, key: str) -> Optional[str]:
+        with session_scope() as session:
+            record = session.get(AppStateRecord, key)
+            return record.value if record else None
+
+    def set(self, key: str, value: Optional[str]) -> None:
+        with session_scope() as session:
+            record = session.get(AppStateRecord, key)
+            if value is None:
+                if record:
+                    session.delete(record)
+                    session.commit()
+                return
+            if not record:
+                record = AppStateRecord(key=key)
+                session.add(record)
+            record.value = value
+            record.updated_at = datetime.now(timezone.utc).replace(tzinfo=None)
+            session.commit()
+
+
+_STORE: Optional[AppStateStore] = None
+
+
+def get_app_state_store() -> AppStateStore:
+    global _STORE  # noqa: PLW0603
+    if _STORE is None:
+        init_database()
+        _STORE = AppStateStore()
+    return _STORE
@@ -0,0 +1,94 @@
+import argparse
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from database import create_sqlite_engine, sqlite_pragmas  # noqa: E402
+
+
+def _default_engine(database_url: str):
+    return create_engine(database_url, connect_args={"check_same_thread": False}, future=True)
+
+
+def _run(engine, readers: int, writers: int, duration: float) -> dict:
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE events (id INTEGER PRIMARY KEY, device TEXT, amount INTEGER)"))
+        connection.execute(
+            text("INSERT INTO events (device, amount) VALUES (:device, :amount)"),
+            [{"device": f"kasse-{index % 10}", "amount": index} for index in range(5000)],
+        )
+
+    counts = {"reads": 0, "writes": 0, "errors": 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def reader() -> None:
+        done = errors = 0
+        while time.monotonic() < deadline:
+            try:
+                with engine.connect() as connection:
+                    connection.execute(
+                        text("SELECT device, SUM(amount) FROM events GROUP BY device ORDER BY device")
+                    ).all()
+                done += 1
+            except OperationalError:
+                errors += 1
+        with lock:
+            counts["reads"] += done
+            counts["errors"] += errors
+
+    def writer(number: int) -> None:
+        done = errors = 0
+        while time.monotonic() < deadline:
+            try:
+                with engine.begin() as connection:
+                    connection.execute(
+                        text("INSERT INTO events (device, amount) VALUES (:device, :amount)"),
+                        {"device": f"kasse-{number}", "amount": done},
+                    )
+                done += 1
+            except OperationalError:
+                errors += 1
+        with lock:
+            counts["writes"] += done
+            counts["errors"] += errors
+
+    threads = [threading.Thread(target=reader) for _ in range(readers)]
+    threads += [threading.Thread(target=writer, args=(number,)) for number in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    engine.dispose()
+    return {name: value / duration if name != "errors" else value for name, value in counts.items()}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare concurrent SQLite throughput with and without tuning.")
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--duration", type=float, default=5.0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        runs = {
+            "default": _default_engine(f"sqlite:///{Path(directory) / 'default.sqlite3'}"),
+            "tuned": create_sqlite_engine(f"sqlite:///{Path(directory) / 'tuned.sqlite3'}", sqlite_pragmas()),
+        }
+        for name, engine in runs.items():
+            result = _run(engine, args.readers, args.writers, args.duration)
+            print(
+                f"{name:8} reads/s={result['reads']:9.1f} writes/s={result['writes']:9.1f} "
+                f"errors={result['errors']}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+
+class TTLCache:
+    def __init__(
+        self,
+        maxsize: int,
+        ttl_seconds: float,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.maxsize = max(int(maxsize), 0)
+        self.ttl_seconds = max(float(ttl_seconds), 0.0)
+        self._clock = clock
+        self._entries: "OrderedDict[Hashable, tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.maxsize > 0 and self.ttl_seconds > 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        if not self.enabled:
+            return default
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires_at, value = entry
+            if expires_at <= self._clock():
+                del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries[key] = (self._clock() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            return entry[1] if entry else None
+
+    def discard_where(self, predicate: Callable[[Hashable, Any], bool]) -> int:
+        with self._lock:
+            stale_keys = [key for key, (_, value) in self._entries.items() if predicate(key, value)]
+            for key in stale_keys:
+                del self._entries[key]
+            return len(stale_keys)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+            }
+
+
+class StaleWhileRevalidateCache:
+    def __init__(
+        self,
+        loader: Callable[[], Any],
+        ttl_seconds: float,
+        on_refresh_error: Optional[Callable[[Exception], None]] = None,
+        clock: Callable[[], float] = time.monotonic,
+        wall_clock: Callable[[], float] = time.time,
+    ):
+        self._loader = loader
+        self.ttl_seconds = max(float(ttl_seconds), 0.0)
+        self._on_refresh_error = on_refresh_error
+        self._clock = clock
+        self._wall_clock = wall_clock
+        self._lock = threading.Lock()
+        self._value: Any = None
+        self._has_value = False
+        self._loaded_at = 0.0
+        self._loaded_at_wall = 0.0
+        self._generation = 0
+        self._refreshing = False
+
+    def get(self) -> tuple[Any, float]:
+        if self.ttl_seconds <= 0:
+            return self._loader(), self._wall_clock()
+        with self._lock:
+            if self._has_value:
+                if self._clock() - self._loaded_at >= self.ttl_seconds and not self._refreshing:
+                    self._refreshing = True
+                    threading.Thread(
+                        target=self._refresh,
+                        args=(self._generation,),
+                        name="stale-while-revalidate",
+                        daemon=True,
+                    ).start()
+                return self._value, self._loaded_at_wall
+            generation = self._generation
+        value = self._loader()
+        with self._lock:
+            if generation == self._generation:
+                self._store(value)
+        return value, self._wall_clock()
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._value = None
+            self._has_value = False
+            self._refreshing = False
+
+    def _store(self, value: Any) -> None:
+        self._value = value
+        self._has_value = True
+        self._loaded_at = self._clock()
+        self._loaded_at_wall = self._wall_clock()
+
+    def _refresh(self, generation: int) -> None:
+        try:
+            value = self._loader()
+        except Exception as err:  # noqa: BLE001
+            if self._on_refresh_error is not None:
+                self._on_refresh_error(err)
+            with self._lock:
+                if generation == self._generation:
+                    self._refreshing = False
+            return
+        with self._lock:
+            if generation == self._generation:
+                self._store(value)
+                self._refreshing = False
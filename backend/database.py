@@ -1,10 +1,40 @@
 from __future__ import annotations
 
 import os
+from contextlib import contextmanager
 from pathlib import Path
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 
-from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Integer, String, create_engine
-from sqlalchemy.orm import declarative_base, sessionmaker
+from flask import Flask, g, has_app_context
+from sqlalchemy import (
+    Boolean,
+    Column,
+    DateTime,
+    ForeignKey,
+    Integer,
+    String,
+    Text,
+    create_engine,
+    event,
+    select,
+    text,
+)
+from sqlalchemy.engine import Connection, Engine, make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, declarative_base, sessionmaker
+from sqlalchemy.pool import QueuePool
+
+_SQLITE_JOURNAL_MODES = {"DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"}
+_SQLITE_SYNCHRONOUS_MODES = {"OFF", "NORMAL", "FULL", "EXTRA"}
+
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL").strip().upper()
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL").strip().upper()
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_CACHE_SIZE_KIB = int(os.getenv("SQLITE_CACHE_SIZE_KIB", "20000"))
+SQLITE_MMAP_SIZE_BYTES = int(os.getenv("SQLITE_MMAP_SIZE_BYTES", str(256 * 1024 * 1024)))
+SQLITE_POOL_SIZE = int(os.getenv("SQLITE_POOL_SIZE", "5"))
+SQLITE_POOL_MAX_OVERFLOW = int(os.getenv("SQLITE_POOL_MAX_OVERFLOW", "10"))
 
 
 def _default_sqlite_path() -> str:
@@ -16,8 +46,55 @@ def _database_url() -> str:
     return os.getenv("DATABASE_URL", _default_sqlite_path())
 
 
+def sqlite_pragmas() -> Dict[str, Any]:
+    if SQLITE_JOURNAL_MODE not in _SQLITE_JOURNAL_MODES:
+        raise RuntimeError(f"Unsupported SQLITE_JOURNAL_MODE: {SQLITE_JOURNAL_MODE}")
+    if SQLITE_SYNCHRONOUS not in _SQLITE_SYNCHRONOUS_MODES:
+        raise RuntimeError(f"Unsupported SQLITE_SYNCHRONOUS: {SQLITE_SYNCHRONOUS}")
+    return {
+        "journal_mode": SQLITE_JOURNAL_MODE,
+        "synchronous": SQLITE_SYNCHRONOUS,
+        "busy_timeout": max(SQLITE_BUSY_TIMEOUT_MS, 0),
+        # Negative cache_size values are interpreted by SQLite as KiB instead of pages.
+        "cache_size": -max(SQLITE_CACHE_SIZE_KIB, 0),
+        "mmap_size": max(SQLITE_MMAP_SIZE_BYTES, 0),
+    }
+
+
+def _is_file_backed_sqlite(database_url: str) -> bool:
+    url = make_url(database_url)
+    return url.get_backend_name() == "sqlite" and url.database not in (None, "", ":memory:")
+
+
+def install_sqlite_pragmas(target: Engine, pragmas: Dict[str, Any]) -> None:
+    @event.listens_for(target, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, _connection_record) -> None:
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+        finally:
+            cursor.close()
+
+
+def create_sqlite_engine(database_url: str, pragmas: Optional[Dict[str, Any]] = None) -> Engine:
+    sqlite_engine = create_engine(
+        database_url,
+        connect_args={"check_same_thread": False},
+        poolclass=QueuePool,
+        pool_size=max(SQLITE_POOL_SIZE, 1),
+        max_overflow=max(SQLITE_POOL_MAX_OVERFLOW, 0),
+        future=True,
+    )
+    if pragmas:
+        install_sqlite_pragmas(sqlite_engine, pragmas)
+    return sqlite_engine
+
+
 def _create_engine():
     database_url = _database_url()
+    if _is_file_backed_sqlite(database_url):
+        return create_sqlite_engine(database_url, sqlite_pragmas())
     connect_args = {"check_same_thread": False} if database_url.startswith("sqlite") else {}
     return create_engine(database_url, connect_args=connect_args, future=True)
 
@@ -27,12 +104,50 @@ engine = _create_engine()
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False, expire_on_commit=False, future=True)
 
 
+@contextmanager
+def session_scope() -> Iterator[Session]:
+    if not has_app_context():
+        with SessionLocal() as session:
+            yield session
+        return
+
+    session = g.get("db_session")
+    if session is None:
+        session = g.db_session = SessionLocal()
+    try:
+        yield session
+    except Exception:
+        session.rollback()
+        raise
+
+
+def end_request_transaction() -> None:
+    # Ends the request session's open transaction before slow work such as password hashing so
+    # its pooled connection is not pinned meanwhile; the session and identity map stay in use.
+    session = g.get("db_session") if has_app_context() else None
+    if session is not None and session.in_transaction():
+        session.commit()
+
+
+def close_request_session(exception: Optional[BaseException] = None) -> None:
+    session = g.pop("db_session", None)
+    if session is None:
+        return
+    if exception is not None:
+        session.rollback()
+    session.close()
+
+
+def init_request_sessions(app: Flask) -> None:
+    app.teardown_appcontext(close_request_session)
+
+
 class UserRecord(Base):
     __tablename__ = "users"
 
     id = Column(Integer, primary_key=True)
     name = Column(String(255), nullable=False)
-    role = Column(String(32), nullable=False)
+    role = Column(String(32), nullable=False, index=True)
     active = Column(Boolean, nullable=False, default=True)
     api_token = Column(String(255), nullable=False, unique=True)
     username = Column(String(255), nullable=True, unique=True)
@@ -43,16 +158,16 @@ class DeviceAssignmentRecord(Base):
     __tablename__ = "device_assignments"
 
     device_id = Column(String(255), primary_key=True)
-    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
 
 
 class PendingDeviceRecord(Base):
     __tablename__ = "pending_devices"
 
     device_id = Column(String(255), primary_key=True)
-    user_id = Column(Integer, nullable=True)
+    user_id = Column(Integer, nullable=True, index=True)
     username = Column(String(255), nullable=True)
-    last_seen_at = Column(DateTime, nullable=False)
+    last_seen_at = Column(DateTime, nullable=False, index=True)
 
 
 class ProductRecord(Base):
@@ -61,8 +176,112 @@ class ProductRecord(Base):
     id = Column(Integer, primary_key=True)
     name = Column(String(255), nullable=False)
     price_cents = Column(Integer, nullable=False)
-    active = Column(Boolean, nullable=False, default=True)
+    active = Column(Boolean, nullable=False, default=True, index=True)
+
+
+class PaymentRecord(Base):
+    __tablename__ = "payments"
+
+    id = Column(String(255), primary_key=True)
+    created = Column(Integer, nullable=False, default=0, index=True)
+    status = Column(String(32), nullable=False)
+    item = Column(String(255), nullable=False, default="-")
+    cashier = Column(String(255), nullable=False, default="-")
+    device = Column(String(255), nullable=False, default="-")
+    amount_cents = Column(Integer, nullable=False, default=0)
+    amount_refunded_cents = Column(Integer, nullable=False, default=0)
+    currency = Column(String(16), nullable=False, default="EUR")
+    refunded = Column(Boolean, nullable=False, default=False)
+    receipt_url = Column(String(1024), nullable=True)
+    charge_id = Column(String(255), nullable=True, index=True)
+    balance_transaction_id = Column(String(255), nullable=True)
+    payout_id = Column(String(255), nullable=True, index=True)
+    payout_label = Column(String(255), nullable=False, default="-")
+    payout_detail = Column(String(255), nullable=False, default="")
+    updated_at = Column(DateTime, nullable=False)
+
+
+class PayoutRecord(Base):
+    __tablename__ = "payouts"
+
+    id = Column(String(255), primary_key=True)
+    status = Column(String(32), nullable=True)
+    arrival_date = Column(Integer, nullable=True)
+    charges_indexed = Column(Boolean, nullable=False, default=False)
+    updated_at = Column(DateTime, nullable=False)
+
+
+class PayoutChargeRecord(Base):
+    __tablename__ = "payout_charges"
+
+    charge_id = Column(String(255), primary_key=True)
+    payout_id = Column(String(255), nullable=False, index=True)
+
+
+class AppStateRecord(Base):
+    __tablename__ = "app_state"
+
+    key = Column(String(255), primary_key=True)
+    value = Column(Text, nullable=True)
+    updated_at = Column(DateTime, nullable=False)
+
+
+class SchemaMigrationRecord(Base):
+    __tablename__ = "schema_migrations"
+
+    version = Column(Integer, primary_key=True)
+    name = Column(String(255), nullable=False)
+    applied_at = Column(DateTime, nullable=False)
+
+
+def _create_index_if_missing(connection: Connection, table: str, column: str) -> None:
+    connection.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{table}_{column} ON {table} ({column})"))
+
+
+def _migration_secondary_indexes(connection: Connection) -> None:
+    _create_index_if_missing(connection, "users", "role")
+    _create_index_if_missing(connection, "device_assignments", "user_id")
+    _create_index_if_missing(connection, "pending_devices", "user_id")
+    _create_index_if_missing(connection, "pending_devices", "last_seen_at")
+    _create_index_if_missing(connection, "products", "active")
+
+
+SCHEMA_MIGRATIONS: Tuple[Tuple[int, str, Callable[[Connection], None]], ...] = (
+    (1, "secondary_indexes", _migration_secondary_indexes),
+)
+
+_MIGRATIONS_APPLIED = False
+
+
+def run_migrations(bind: Optional[Engine] = None) -> List[int]:
+    bind = bind or engine
+    with bind.connect() as connection:
+        applied = set(connection.execute(select(SchemaMigrationRecord.version)).scalars())
+
+    newly_applied = []
+    for version, name, migration in SCHEMA_MIGRATIONS:
+        if version in applied:
+            continue
+        try:
+            with bind.begin() as connection:
+                migration(connection)
+                connection.execute(
+                    SchemaMigrationRecord.__table__.insert().values(
+                        version=version,
+                        name=name,
+                        applied_at=datetime.now(timezone.utc).replace(tzinfo=None),
+                    )
+                )
+        except IntegrityError:
+            # Another process recorded the same version first; the migrations are idempotent.
+            continue
+        newly_applied.append(version)
+    return newly_applied
 
 
 def init_database() -> None:
+    global _MIGRATIONS_APPLIED  # noqa: PLW0603
     Base.metadata.create_all(bind=engine)
+    if not _MIGRATIONS_APPLIED:
+        run_migrations()
+        _MIGRATIONS_APPLIED = True
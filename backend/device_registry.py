@@ -1,10 +1,23 @@
 from __future__ import annotations
 
+import os
+import threading
+import time
 from datetime import datetime, timezone
 from dataclasses import dataclass
-from typing import Iterable, Optional
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
-from database import DeviceAssignmentRecord, PendingDeviceRecord, SessionLocal, init_database
+from sqlalchemy import DateTime, Integer, String, and_, delete, exists, func, literal, or_, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from database import DeviceAssignmentRecord, PendingDeviceRecord, UserRecord, init_database, session_scope
+from users import User, user_from_record
+
+_UPSERT_DIALECTS = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}
+
+PENDING_DEVICE_FLUSH_INTERVAL_SECONDS = float(os.getenv("PENDING_DEVICE_FLUSH_INTERVAL_SECONDS", "10"))
+PENDING_DEVICE_FLUSH_MAX_ENTRIES = int(os.getenv("PENDING_DEVICE_FLUSH_MAX_ENTRIES", "50"))
 
 
 @dataclass(frozen=True)
@@ -21,7 +34,37 @@ class PendingDevice:
     last_seen_at: datetime
 
 
+PendingDeviceCursor = Tuple[datetime, str]
+
+
+@dataclass(frozen=True)
+class PendingDevicePage:
+    devices: List[PendingDevice]
+    total: int
+    next_cursor: Optional[PendingDeviceCursor]
+
+
+@dataclass(frozen=True)
+class AssignedDevice:
+    device_id: str
+    user_id: int
+    user: Optional[User]
+
+
+@dataclass(frozen=True)
+class AdminOverview:
+    users: List[User]
+    devices: List[AssignedDevice]
+    pending: PendingDevicePage
+
+
 class DeviceRegistry:
+    def __init__(self):
+        self._heartbeat_lock = threading.Lock()
+        self._heartbeats: Dict[str, Tuple[Optional[int], Optional[str], datetime]] = {}
+        self._known_pending: Set[str] = set()
+        self._last_flush = time.monotonic()
+
     @staticmethod
     def _to_assignment(record: DeviceAssignmentRecord) -> DeviceAssignment:
         return DeviceAssignment(device_id=record.device_id, user_id=record.user_id)
@@ -36,28 +79,49 @@ class DeviceRegistry:
         )
 
     def list_devices(self) -> Iterable[DeviceAssignment]:
-        with SessionLocal() as session:
+        with session_scope() as session:
             records = session.query(DeviceAssignmentRecord).order_by(DeviceAssignmentRecord.device_id.asc()).all()
             return [self._to_assignment(record) for record in records]
 
+    @staticmethod
+    def _native_insert(session: Session):
+        return _UPSERT_DIALECTS.get(session.get_bind().dialect.name)
+
     def assign_device(self, device_id: str, user_id: int) -> DeviceAssignment:
         normalized_device_id = device_id.strip()
-        with SessionLocal() as session:
-            record = session.get(DeviceAssignmentRecord, normalized_device_id)
-            if not record:
-                record = DeviceAssignmentRecord(device_id=normalized_device_id, user_id=user_id)
-                session.add(record)
-            else:
-                record.user_id = user_id
-            pending = session.get(PendingDeviceRecord, normalized_device_id)
-            if pending:
-                session.delete(pending)
+        with self._heartbeat_lock:
+            self._heartbeats.pop(normalized_device_id, None)
+            self._known_pending.discard(normalized_device_id)
+        with session_scope() as session:
+            insert = self._native_insert(session)
+            if insert is None:
+                return self._assign_device_orm(session, normalized_device_id, user_id)
+            statement = insert(DeviceAssignmentRecord).values(device_id=normalized_device_id, user_id=user_id)
+            statement = statement.on_conflict_do_update(
+                index_elements=[DeviceAssignmentRecord.device_id],
+                set_={"user_id": statement.excluded.user_id},
+            ).returning(DeviceAssignmentRecord)
+            record = session.scalars(statement, execution_options={"populate_existing": True}).one()
+            session.execute(delete(PendingDeviceRecord).where(PendingDeviceRecord.device_id == normalized_device_id))
             session.commit()
-            session.refresh(record)
             return self._to_assignment(record)
 
+    def _assign_device_orm(self, session: Session, device_id: str, user_id: int) -> DeviceAssignment:
+        record = session.get(DeviceAssignmentRecord, device_id)
+        if not record:
+            record = DeviceAssignmentRecord(device_id=device_id, user_id=user_id)
+            session.add(record)
+        else:
+            record.user_id = user_id
+        pending = session.get(PendingDeviceRecord, device_id)
+        if pending:
+            session.delete(pending)
+        session.commit()
+        session.refresh(record)
+        return self._to_assignment(record)
+
     def get_device(self, device_id: str) -> Optional[DeviceAssignment]:
-        with SessionLocal() as session:
+        with session_scope() as session:
             record = session.get(DeviceAssignmentRecord, device_id.strip())
             return self._to_assignment(record) if record else None
 
@@ -71,44 +135,237 @@ class DeviceRegistry:
         if not normalized_device_id:
             return None
         now = datetime.now(timezone.utc).replace(tzinfo=None)
-        with SessionLocal() as session:
-            if session.get(DeviceAssignmentRecord, normalized_device_id):
-                pending = session.get(PendingDeviceRecord, normalized_device_id)
-                if pending:
-                    session.delete(pending)
-                    session.commit()
-                return None
-
-            record = session.get(PendingDeviceRecord, normalized_device_id)
-            if not record:
-                record = PendingDeviceRecord(device_id=normalized_device_id)
-                session.add(record)
-            record.user_id = user_id
-            record.username = username
-            record.last_seen_at = now
+        with session_scope() as session:
+            insert = self._native_insert(session)
+            if insert is None:
+                return self._remember_pending_device_orm(session, normalized_device_id, user_id, username, now)
+            # Assigned devices are skipped inside the statement, so a login costs a single round-trip.
+            candidate = select(
+                literal(normalized_device_id, String),
+                literal(user_id, Integer),
+                literal(username, String),
+                literal(now, DateTime),
+            ).where(~exists().where(DeviceAssignmentRecord.device_id == normalized_device_id))
+            statement = insert(PendingDeviceRecord).from_select(
+                ["device_id", "user_id", "username", "last_seen_at"],
+                candidate,
+            )
+            statement = statement.on_conflict_do_update(
+                index_elements=[PendingDeviceRecord.device_id],
+                set_={
+                    "user_id": statement.excluded.user_id,
+                    "username": statement.excluded.username,
+                    "last_seen_at": statement.excluded.last_seen_at,
+                },
+            ).returning(PendingDeviceRecord)
+            record = session.scalars(statement, execution_options={"populate_existing": True}).first()
+            session.commit()
+            return self._to_pending_device(record) if record else None
+
+    def _remember_pending_device_orm(
+        self,
+        session: Session,
+        device_id: str,
+        user_id: Optional[int],
+        username: Optional[str],
+        now: datetime,
+    ) -> Optional[PendingDevice]:
+        if session.get(DeviceAssignmentRecord, device_id):
+            pending = session.get(PendingDeviceRecord, device_id)
+            if pending:
+                session.delete(pending)
+                session.commit()
+            return None
+
+        record = session.get(PendingDeviceRecord, device_id)
+        if not record:
+            record = PendingDeviceRecord(device_id=device_id)
+            session.add(record)
+        record.user_id = user_id
+        record.username = username
+        record.last_seen_at = now
+        session.commit()
+        session.refresh(record)
+        return self._to_pending_device(record)
+
+    def touch_pending_device(
+        self,
+        device_id: str,
+        user_id: Optional[int] = None,
+        username: Optional[str] = None,
+    ) -> bool:
+        normalized_device_id = device_id.strip()
+        if not normalized_device_id:
+            return False
+        if PENDING_DEVICE_FLUSH_INTERVAL_SECONDS <= 0:
+            return self.remember_pending_device(normalized_device_id, user_id, username) is not None
+
+        with self._heartbeat_lock:
+            known = normalized_device_id in self._known_pending
+            if known:
+                now = datetime.now(timezone.utc).replace(tzinfo=None)
+                self._heartbeats[normalized_device_id] = (user_id, username, now)
+                flush_due = (
+                    len(self._heartbeats) >= PENDING_DEVICE_FLUSH_MAX_ENTRIES
+                    or time.monotonic() - self._last_flush >= PENDING_DEVICE_FLUSH_INTERVAL_SECONDS
+                )
+        if known:
+            if flush_due:
+                self.flush_pending_heartbeats()
+            return True
+
+        pending = self.remember_pending_device(normalized_device_id, user_id, username)
+        if pending is None:
+            return False
+        with self._heartbeat_lock:
+            self._known_pending.add(normalized_device_id)
+        return True
+
+    def flush_pending_heartbeats(self) -> int:
+        with self._heartbeat_lock:
+            heartbeats, self._heartbeats = self._heartbeats, {}
+            self._last_flush = time.monotonic()
+        if not heartbeats:
+            return 0
+
+        with session_scope() as session:
+            assigned_device_ids = set(
+                session.scalars(
+                    select(DeviceAssignmentRecord.device_id).where(
+                        DeviceAssignmentRecord.device_id.in_(list(heartbeats))
+                    )
+                )
+            )
+            rows = [
+                {"device_id": device_id, "user_id": user_id, "username": username, "last_seen_at": seen_at}
+                for device_id, (user_id, username, seen_at) in heartbeats.items()
+                if device_id not in assigned_device_ids
+            ]
+            insert = self._native_insert(session)
+            if rows and insert is not None:
+                statement = insert(PendingDeviceRecord).values(rows)
+                statement = statement.on_conflict_do_update(
+                    index_elements=[PendingDeviceRecord.device_id],
+                    set_={
+                        "user_id": statement.excluded.user_id,
+                        "username": statement.excluded.username,
+                        "last_seen_at": statement.excluded.last_seen_at,
+                    },
+                )
+                session.execute(statement)
+            elif rows:
+                for row in rows:
+                    record = session.get(PendingDeviceRecord, row["device_id"]) or PendingDeviceRecord(
+                        device_id=row["device_id"]
+                    )
+                    record.user_id = row["user_id"]
+                    record.username = row["username"]
+                    record.last_seen_at = row["last_seen_at"]
+                    session.add(record)
+            if assigned_device_ids:
+                session.execute(
+                    delete(PendingDeviceRecord).where(PendingDeviceRecord.device_id.in_(assigned_device_ids))
+                )
             session.commit()
-            session.refresh(record)
-            return self._to_pending_device(record)
-
-    def list_pending_devices(self) -> Iterable[PendingDevice]:
-        with SessionLocal() as session:
-            assigned_device_ids = {
-                device_id
-                for (device_id,) in session.query(DeviceAssignmentRecord.device_id).all()
-            }
-            records = (
-                session.query(PendingDeviceRecord)
-                .order_by(PendingDeviceRecord.last_seen_at.desc(), PendingDeviceRecord.device_id.asc())
-                .all()
+
+        if assigned_device_ids:
+            with self._heartbeat_lock:
+                self._known_pending.difference_update(assigned_device_ids)
+        return len(rows)
+
+    def discard_pending_heartbeats_for_user(self, user_id: int) -> None:
+        with self._heartbeat_lock:
+            for device_id in [key for key, entry in self._heartbeats.items() if entry[0] == user_id]:
+                del self._heartbeats[device_id]
+                self._known_pending.discard(device_id)
+
+    @staticmethod
+    def _unassigned_pending_filter():
+        return ~exists().where(DeviceAssignmentRecord.device_id == PendingDeviceRecord.device_id)
+
+    def list_pending_devices(
+        self,
+        limit: Optional[int] = None,
+        after: Optional[PendingDeviceCursor] = None,
+    ) -> List[PendingDevice]:
+        self.flush_pending_heartbeats()
+        with session_scope() as session:
+            query = session.query(PendingDeviceRecord).filter(self._unassigned_pending_filter())
+            if after is not None:
+                last_seen_at, device_id = after
+                query = query.filter(
+                    or_(
+                        PendingDeviceRecord.last_seen_at < last_seen_at,
+                        and_(PendingDeviceRecord.last_seen_at == last_seen_at, PendingDeviceRecord.device_id > device_id),
+                    )
+                )
+            query = query.order_by(PendingDeviceRecord.last_seen_at.desc(), PendingDeviceRecord.device_id.asc())
+            if limit is not None:
+                query = query.limit(limit)
+            return [self._to_pending_device(record) for record in query.all()]
+
+    def count_pending_devices(self) -> int:
+        self.flush_pending_heartbeats()
+        with session_scope() as session:
+            return session.scalar(
+                select(func.count()).select_from(PendingDeviceRecord).where(self._unassigned_pending_filter())
+            )
+
+    def page_pending_devices(self, limit: int, after: Optional[PendingDeviceCursor] = None) -> PendingDevicePage:
+        devices = self.list_pending_devices(limit=limit + 1, after=after)
+        next_cursor = None
+        if len(devices) > limit:
+            devices = devices[:limit]
+            next_cursor = (devices[-1].last_seen_at, devices[-1].device_id)
+        return PendingDevicePage(devices=devices, total=self.count_pending_devices(), next_cursor=next_cursor)
+
+    @staticmethod
+    def _assigned_devices(
+        session: Session,
+        limit: Optional[int] = None,
+        after: Optional[str] = None,
+    ) -> List[AssignedDevice]:
+        query = session.query(DeviceAssignmentRecord, UserRecord).outerjoin(
+            UserRecord, UserRecord.id == DeviceAssignmentRecord.user_id
+        )
+        if after is not None:
+            query = query.filter(DeviceAssignmentRecord.device_id > after)
+        query = query.order_by(DeviceAssignmentRecord.device_id.asc())
+        if limit is not None:
+            query = query.limit(limit)
+        return [
+            AssignedDevice(
+                device_id=assignment.device_id,
+                user_id=assignment.user_id,
+                user=user_from_record(user) if user else None,
             )
-            return [
-                self._to_pending_device(record)
-                for record in records
-                if record.device_id not in assigned_device_ids
+            for assignment, user in query.all()
+        ]
+
+    def list_devices_with_users(
+        self,
+        limit: Optional[int] = None,
+        after: Optional[str] = None,
+    ) -> List[AssignedDevice]:
+        with session_scope() as session:
+            return self._assigned_devices(session, limit=limit, after=after)
+
+    def admin_overview(
+        self,
+        pending_limit: int,
+        pending_after: Optional[PendingDeviceCursor] = None,
+    ) -> AdminOverview:
+        pending = self.page_pending_devices(limit=pending_limit, after=pending_after)
+        with session_scope() as session:
+            users = [
+                user_from_record(record)
+                for record in session.query(UserRecord).order_by(UserRecord.id.asc()).all()
             ]
+            devices = self._assigned_devices(session)
+        return AdminOverview(users=users, devices=devices, pending=pending)
 
     def delete_device(self, device_id: str) -> bool:
-        with SessionLocal() as session:
+        with session_scope() as session:
             record = session.get(DeviceAssignmentRecord, device_id.strip())
             if not record:
                 return False
@@ -117,11 +374,10 @@ class DeviceRegistry:
             return True
 
     def delete_devices_for_user(self, user_id: int) -> None:
-        with SessionLocal() as session:
-            for record in session.query(DeviceAssignmentRecord).filter(DeviceAssignmentRecord.user_id == user_id).all():
-                session.delete(record)
-            for record in session.query(PendingDeviceRecord).filter(PendingDeviceRecord.user_id == user_id).all():
-                session.delete(record)
+        self.discard_pending_heartbeats_for_user(user_id)
+        with session_scope() as session:
+            session.execute(delete(DeviceAssignmentRecord).where(DeviceAssignmentRecord.user_id == user_id))
+            session.execute(delete(PendingDeviceRecord).where(PendingDeviceRecord.user_id == user_id))
             session.commit()
 
 
@@ -9,10 +9,22 @@ logger = logging.getLogger(__name__)
 
 
 class APIError(Exception):
-    def __init__(self, message: str, status_code: int = 400, extra: Dict[str, Any] | None = None):
+    def __init__(
+        self,
+        message: str,
+        status_code: int = 400,
+        extra: Dict[str, Any] | None = None,
+        headers: Dict[str, str] | None = None,
+    ):
         super().__init__(message)
         self.status_code = status_code
         self.extra = extra or {}
+        self.headers = headers or {}
+
+
+class ServiceBusyError(APIError):
+    def __init__(self, message: str, retry_after_seconds: int = 1):
+        super().__init__(message, 503, headers={"Retry-After": str(retry_after_seconds)})
 
 
 def handle_errors(func):
@@ -24,7 +36,7 @@ def handle_errors(func):
             logger.warning("API error: %s", api_err)
             response = {"error": str(api_err)}
             response.update(api_err.extra)
-            return jsonify(response), api_err.status_code
+            return jsonify(response), api_err.status_code, api_err.headers
         except stripe.error.StripeError as err:
             logger.exception("Stripe error while processing request")
             return jsonify({"error": str(err)}), 500
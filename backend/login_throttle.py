@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import threading
+import time
+from typing import Callable, Dict, Iterable, Tuple
+
+
+class LoginThrottle:
+    def __init__(
+        self,
+        burst: int,
+        refill_per_minute: float,
+        max_keys: int = 10000,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.burst = max(int(burst), 0)
+        self.refill_per_second = max(float(refill_per_minute), 0.0) / 60
+        self.max_keys = max(int(max_keys), 1)
+        self._clock = clock
+        self._lock = threading.Lock()
+        # key -> (tokens, updated_at); tuples keep the per-key state small.
+        self._buckets: Dict[Tuple[str, str], Tuple[float, float]] = {}
+        self._next_sweep = clock() + self._idle_seconds()
+        self.allowed = 0
+        self.rejected: Dict[str, int] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.burst > 0 and self.refill_per_second > 0
+
+    def _idle_seconds(self) -> float:
+        if self.refill_per_second <= 0:
+            return 60.0
+        return self.burst / self.refill_per_second
+
+    def _tokens(self, key: Tuple[str, str], now: float) -> float:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return float(self.burst)
+        tokens, updated_at = bucket
+        return min(self.burst, tokens + (now - updated_at) * self.refill_per_second)
+
+    def _sweep(self, now: float) -> None:
+        # A bucket that has refilled completely carries no state worth keeping.
+        full = [key for key in self._buckets if self._tokens(key, now) >= self.burst]
+        for key in full:
+            del self._buckets[key]
+        # Under a spray of distinct keys, forget the oldest buckets rather than grow without bound.
+        while len(self._buckets) >= self.max_keys:
+            del self._buckets[next(iter(self._buckets))]
+        self._next_sweep = now + self._idle_seconds()
+
+    def _maybe_sweep(self, now: float) -> None:
+        if now >= self._next_sweep or len(self._buckets) >= self.max_keys:
+            self._sweep(now)
+
+    def acquire(self, keys: Iterable[Tuple[str, str]], check_only: Iterable[Tuple[str, str]] = ()) -> float:
+        # Keys in check_only must have a token left but are not charged; see penalize().
+        if not self.enabled:
+            return 0.0
+        keys = [key for key in keys if key[1]]
+        check_only = [key for key in check_only if key[1]]
+        with self._lock:
+            now = self._clock()
+            self._maybe_sweep(now)
+            levels = {key: self._tokens(key, now) for key in [*keys, *check_only]}
+            exhausted = [key for key, tokens in levels.items() if tokens < 1]
+            if exhausted:
+                for kind, _ in exhausted:
+                    self.rejected[kind] = self.rejected.get(kind, 0) + 1
+                missing = max(1 - levels[key] for key in exhausted)
+                return max(missing / self.refill_per_second, 1.0)
+            for key in keys:
+                self._buckets[key] = (levels[key] - 1, now)
+            self.allowed += 1
+            return 0.0
+
+    def penalize(self, keys: Iterable[Tuple[str, str]]) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            now = self._clock()
+            self._maybe_sweep(now)
+            for key in keys:
+                if key[1]:
+                    self._buckets[key] = (max(self._tokens(key, now) - 1, 0.0), now)
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            return {
+                "tracked_keys": len(self._buckets),
+                "allowed": self.allowed,
+                "rejected": dict(self.rejected),
+            }
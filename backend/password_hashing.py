@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from functools import lru_cache
+from typing import Callable, Dict, TypeVar
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from errors import ServiceBusyError
+
+PASSWORD_HASH_WORKERS = max(int(os.getenv("PASSWORD_HASH_WORKERS", str(max((os.cpu_count() or 2) // 2, 1)))), 1)
+PASSWORD_HASH_QUEUE_SIZE = max(int(os.getenv("PASSWORD_HASH_QUEUE_SIZE", "16")), 0)
+PASSWORD_HASH_TIMEOUT_SECONDS = float(os.getenv("PASSWORD_HASH_TIMEOUT_SECONDS", "10"))
+PASSWORD_HASH_METHOD = os.getenv("PASSWORD_HASH_METHOD", "scrypt:32768:8:1").strip()
+
+BUSY_MESSAGE = "Anmeldung ist gerade ausgelastet, bitte gleich erneut versuchen"
+
+T = TypeVar("T")
+
+
+class PasswordHashExecutor:
+    def __init__(self, workers: int, queue_size: int, timeout_seconds: float):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._timeout_seconds = timeout_seconds
+        self._lock = threading.Lock()
+        self.workers = workers
+        self.queue_size = queue_size
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def run(self, func: Callable[..., T], *args) -> T:
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise ServiceBusyError(BUSY_MESSAGE)
+        with self._lock:
+            self.in_flight += 1
+        try:
+            future = self._executor.submit(self._run_and_release, func, args)
+        except BaseException:
+            self._release()
+            raise
+        try:
+            return future.result(timeout=self._timeout_seconds)
+        except FutureTimeoutError:
+            raise ServiceBusyError(BUSY_MESSAGE)
+
+    def _run_and_release(self, func: Callable[..., T], args: tuple) -> T:
+        try:
+            return func(*args)
+        finally:
+            self._release()
+
+    def _release(self) -> None:
+        with self._lock:
+            self.in_flight -= 1
+            self.completed += 1
+        self._slots.release()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queue_size": self.queue_size,
+                "in_flight": self.in_flight,
+                "completed": self.completed,
+                "rejected": self.rejected,
+            }
+
+
+_EXECUTOR = PasswordHashExecutor(PASSWORD_HASH_WORKERS, PASSWORD_HASH_QUEUE_SIZE, PASSWORD_HASH_TIMEOUT_SECONDS)
+
+
+def get_password_hash_executor() -> PasswordHashExecutor:
+    return _EXECUTOR
+
+
+def _generate(password: str) -> str:
+    return generate_password_hash(password, method=PASSWORD_HASH_METHOD)
+
+
+def hash_password(password: str) -> str:
+    return _EXECUTOR.run(_generate, password)
+
+
+def hash_password_blocking(password: str) -> str:
+    # Startup and CLI paths hash on the calling thread so they never compete for request slots.
+    return _generate(password)
+
+
+def verify_password(password_hash: str, password: str) -> bool:
+    return _EXECUTOR.run(check_password_hash, password_hash, password)
+
+
+@lru_cache(maxsize=8)
+def _effective_method(method: str) -> str:
+    # werkzeug fills in default parameters ("scrypt" -> "scrypt:32768:8:1"); compare against that form.
+    return generate_password_hash("", method=method).split("$", 1)[0]
+
+
+def _validate_method(method: str) -> None:
+    # A typo would otherwise only surface as a 500 on the next login or password change.
+    try:
+        _effective_method(method)
+    except ValueError as err:
+        raise RuntimeError(f"Unsupported PASSWORD_HASH_METHOD: {method}") from err
+
+
+_validate_method(PASSWORD_HASH_METHOD)
+
+
+def needs_rehash(password_hash: str) -> bool:
+    return password_hash.split("$", 1)[0] != _effective_method(PASSWORD_HASH_METHOD)
+
+
+def _time_verify_ms(method: str, rounds: int = 3) -> float:
+    password_hash = generate_password_hash("calibration-password", method=method)
+    timings = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        check_password_hash(password_hash, "calibration-password")
+        timings.append((time.perf_counter() - started) * 1000)
+    return min(timings)
+
+
+def calibrate_method(target_ms: float, algorithm: str = "scrypt") -> str:
+    if algorithm == "scrypt":
+        n = 2**12
+        method = f"scrypt:{n}:8:1"
+        # Memory and time grow linearly with n; stop before werkzeug's scrypt maxmem gets unreasonable.
+        while _time_verify_ms(method) < target_ms and n < 2**20:
+            n *= 2
+            method = f"scrypt:{n}:8:1"
+        return method
+    if algorithm == "pbkdf2":
+        sample_iterations = 20_000
+        elapsed_ms = _time_verify_ms(f"pbkdf2:sha256:{sample_iterations}")
+        iterations = max(int(sample_iterations * target_ms / max(elapsed_ms, 0.001)), 1_000)
+        return f"pbkdf2:sha256:{iterations}"
+    raise ValueError(f"Unsupported password hash algorithm: {algorithm}")
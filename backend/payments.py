@@ -0,0 +1,235 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, Optional
+
+from database import PaymentRecord, PayoutChargeRecord, PayoutRecord, init_database, session_scope
+
+_PAYMENT_FIELDS = (
+    "created",
+    "status",
+    "item",
+    "cashier",
+    "device",
+    "amount_cents",
+    "amount_refunded_cents",
+    "currency",
+    "refunded",
+    "receipt_url",
+    "charge_id",
+    "balance_transaction_id",
+    "payout_id",
+    "payout_label",
+    "payout_detail",
+)
+
+
+@dataclass
+class Payment:
+    id: str
+    created: int
+    status: str
+    item: str
+    cashier: str
+    device: str
+    amount_cents: int
+    amount_refunded_cents: int
+    currency: str
+    refunded: bool
+    receipt_url: Optional[str]
+    charge_id: Optional[str]
+    balance_transaction_id: Optional[str]
+    payout_id: Optional[str]
+    payout_label: str
+    payout_detail: str
+
+    @property
+    def refundable_cents(self) -> int:
+        return max(self.amount_cents - self.amount_refunded_cents, 0)
+
+
+@dataclass
+class Payout:
+    id: str
+    status: Optional[str]
+    arrival_date: Optional[int]
+    charges_indexed: bool
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class PaymentStore:
+    @staticmethod
+    def _to_payment(record: PaymentRecord) -> Payment:
+        return Payment(
+            id=record.id,
+            created=record.created,
+            status=record.status,
+            item=record.item,
+            cashier=record.cashier,
+            device=record.device,
+            amount_cents=record.amount_cents,
+            amount_refunded_cents=record.amount_refunded_cents,
+            currency=record.currency,
+            refunded=record.refunded,
+            receipt_url=record.receipt_url,
+            charge_id=record.charge_id,
+            balance_transaction_id=record.balance_transaction_id,
+            payout_id=record.payout_id,
+            payout_label=record.payout_label,
+            payout_detail=record.payout_detail,
+        )
+
+    @staticmethod
+    def _apply_fields(record: PaymentRecord, fields: Dict[str, Any]) -> None:
+        refunded_cents = record.amount_refunded_cents or 0
+        refunded = bool(record.refunded)
+        for name in _PAYMENT_FIELDS:
+            if name in fields and fields[name] is not None:
+                setattr(record, name, fields[name])
+        # Refunds only ever grow; an older Stripe object arriving late must not undo a newer one.
+        record.amount_refunded_cents = max(record.amount_refunded_cents or 0, refunded_cents)
+        record.refunded = bool(record.refunded) or refunded
+        record.updated_at = _utcnow()
+
+    def has_payments(self) -> bool:
+        with session_scope() as session:
+            return session.query(PaymentRecord.id).first() is not None
+
+    def list_successful_payments(self) -> Iterable[Payment]:
+        with session_scope() as session:
+            records = (
+                session.query(PaymentRecord)
+                .filter(PaymentRecord.status == "succeeded")
+                .order_by(PaymentRecord.created.desc(), PaymentRecord.id.desc())
+                .all()
+            )
+            return [self._to_payment(record) for record in records]
+
+    def get_payment(self, payment_id: str) -> Optional[Payment]:
+        with session_scope() as session:
+            record = session.get(PaymentRecord, payment_id)
+            return self._to_payment(record) if record else None
+
+    def get_payments(self, payment_ids: Iterable[str]) -> Dict[str, Payment]:
+        payment_ids = list(payment_ids)
+        if not payment_ids:
+            return {}
+        with session_scope() as session:
+            records = session.query(PaymentRecord).filter(PaymentRecord.id.in_(payment_ids)).all()
+            return {record.id: self._to_payment(record) for record in records}
+
+    def upsert_payment(self, payment_id: str, fields: Dict[str, Any]) -> Payment:
+        with session_scope() as session:
+            record = session.get(PaymentRecord, payment_id)
+            if not record:
+                record = PaymentRecord(id=payment_id, status=fields.get("status") or "-")
+                session.add(record)
+            self._apply_fields(record, fields)
+            session.commit()
+            session.refresh(record)
+            return self._to_payment(record)
+
+    def update_payment(self, payment_id: str, fields: Dict[str, Any]) -> Optional[Payment]:
+        with session_scope() as session:
+            record = session.get(PaymentRecord, payment_id)
+            if not record:
+                return None
+            self._apply_fields(record, fields)
+            session.commit()
+            session.refresh(record)
+            return self._to_payment(record)
+
+    def update_payout_status(
+        self,
+        payout_id: str,
+        payout_label: str,
+        payout_detail: str,
+        charge_ids: Iterable[str] = (),
+    ) -> int:
+        charge_ids = [charge_id for charge_id in charge_ids if charge_id]
+        with session_scope() as session:
+            query = session.query(PaymentRecord)
+            if charge_ids:
+                query = query.filter(
+                    (PaymentRecord.payout_id == payout_id) | PaymentRecord.charge_id.in_(charge_ids)
+                )
+            else:
+                query = query.filter(PaymentRecord.payout_id == payout_id)
+            records = query.all()
+            now = _utcnow()
+            for record in records:
+                record.payout_id = payout_id
+                record.payout_label = payout_label
+                record.payout_detail = payout_detail
+                record.updated_at = now
+            session.commit()
+            return len(records)
+
+    @staticmethod
+    def _to_payout(record: PayoutRecord) -> Payout:
+        return Payout(
+            id=record.id,
+            status=record.status,
+            arrival_date=record.arrival_date,
+            charges_indexed=record.charges_indexed,
+        )
+
+    def get_payouts(self, payout_ids: Iterable[str]) -> Dict[str, Payout]:
+        payout_ids = list(payout_ids)
+        if not payout_ids:
+            return {}
+        with session_scope() as session:
+            records = session.query(PayoutRecord).filter(PayoutRecord.id.in_(payout_ids)).all()
+            return {record.id: self._to_payout(record) for record in records}
+
+    def store_payout(
+        self,
+        payout_id: str,
+        status: Optional[str],
+        arrival_date: Optional[int],
+        charge_ids: Optional[Iterable[str]] = None,
+    ) -> Payout:
+        with session_scope() as session:
+            record = session.get(PayoutRecord, payout_id)
+            if not record:
+                record = PayoutRecord(id=payout_id, charges_indexed=False)
+                session.add(record)
+            record.status = status
+            record.arrival_date = arrival_date
+            record.updated_at = _utcnow()
+            if charge_ids is not None:
+                for charge_id in charge_ids:
+                    if charge_id:
+                        session.merge(PayoutChargeRecord(charge_id=charge_id, payout_id=payout_id))
+                record.charges_indexed = True
+            session.commit()
+            session.refresh(record)
+            return self._to_payout(record)
+
+    def payouts_for_charges(self, charge_ids: Iterable[str]) -> Dict[str, Payout]:
+        charge_ids = [charge_id for charge_id in charge_ids if charge_id]
+        if not charge_ids:
+            return {}
+        with session_scope() as session:
+            rows = (
+                session.query(PayoutChargeRecord.charge_id, PayoutRecord)
+                .join(PayoutRecord, PayoutRecord.id == PayoutChargeRecord.payout_id)
+                .filter(PayoutChargeRecord.charge_id.in_(charge_ids))
+                .all()
+            )
+            return {charge_id: self._to_payout(record) for charge_id, record in rows}
+
+
+_STORE: Optional[PaymentStore] = None
+
+
+def get_payment_store() -> PaymentStore:
+    global _STORE  # noqa: PLW0603
+    if _STORE is None:
+        init_database()
+        _STORE = PaymentStore()
+    return _STORE
@@ -3,7 +3,7 @@ from __future__ import annotations
 from dataclasses import dataclass
 from typing import Iterable, Optional
 
-from database import ProductRecord, SessionLocal, init_database
+from database import ProductRecord, init_database, session_scope
 
 
 @dataclass
@@ -25,12 +25,12 @@ class ProductStore:
         )
 
     def list_products(self) -> Iterable[Product]:
-        with SessionLocal() as session:
+        with session_scope() as session:
             records = session.query(ProductRecord).order_by(ProductRecord.id.asc()).all()
             return [self._to_product(record) for record in records]
 
     def create_product(self, name: str, price_cents: int, active: bool = True) -> Product:
-        with SessionLocal() as session:
+        with session_scope() as session:
             record = ProductRecord(name=name, price_cents=price_cents, active=active)
             session.add(record)
             session.commit()
@@ -44,7 +44,7 @@ class ProductStore:
         price_cents: Optional[int] = None,
         active: Optional[bool] = None,
     ) -> Optional[Product]:
-        with SessionLocal() as session:
+        with session_scope() as session:
             record = session.get(ProductRecord, product_id)
             if not record:
                 return None
@@ -59,7 +59,7 @@ class ProductStore:
             return self._to_product(record)
 
     def delete_product(self, product_id: int) -> bool:
-        with SessionLocal() as session:
+        with session_scope() as session:
             record = session.get(ProductRecord, product_id)
             if not record:
                 return False
@@ -68,7 +68,7 @@ class ProductStore:
             return True
 
     def has_products(self) -> bool:
-        with SessionLocal() as session:
+        with session_scope() as session:
             record = session.query(ProductRecord.id).first()
             return record is not None
 
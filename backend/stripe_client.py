@@ -0,0 +1,50 @@
+from __future__ import annotations
+
+import os
+from typing import Callable, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+import stripe
+
+STRIPE_CONNECT_TIMEOUT_SECONDS = float(os.getenv("STRIPE_CONNECT_TIMEOUT_SECONDS", "5"))
+STRIPE_READ_TIMEOUT_SECONDS = float(os.getenv("STRIPE_READ_TIMEOUT_SECONDS", "30"))
+STRIPE_MAX_NETWORK_RETRIES = int(os.getenv("STRIPE_MAX_NETWORK_RETRIES", "2"))
+STRIPE_HTTP_POOL_SIZE = int(os.getenv("STRIPE_HTTP_POOL_SIZE", "10"))
+
+
+class StripeRequestsClient(stripe.RequestsClient):
+    def __init__(self, *args, before_request: Optional[Callable[[], None]] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._before_request = before_request
+
+    def request(self, method, url, headers, post_data=None):
+        # Called for every attempt, retries included, right before the network round trip.
+        if self._before_request is not None:
+            self._before_request()
+        return super().request(method, url, headers, post_data)
+
+
+def create_stripe_http_client(
+    connect_timeout: float = STRIPE_CONNECT_TIMEOUT_SECONDS,
+    read_timeout: float = STRIPE_READ_TIMEOUT_SECONDS,
+    pool_size: int = STRIPE_HTTP_POOL_SIZE,
+    before_request: Optional[Callable[[], None]] = None,
+) -> stripe.HTTPClient:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(pool_size, 1))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return StripeRequestsClient(
+        timeout=(connect_timeout, read_timeout),
+        session=session,
+        before_request=before_request,
+    )
+
+
+def configure_stripe(api_key: str, api_version: str, before_request: Optional[Callable[[], None]] = None) -> None:
+    stripe.api_key = api_key
+    stripe.api_version = api_version
+    stripe.default_http_client = create_stripe_http_client(before_request=before_request)
+    # Stripe attaches an Idempotency-Key to every POST, so retried writes are not applied twice.
+    stripe.max_network_retries = max(STRIPE_MAX_NETWORK_RETRIES, 0)
@@ -1,6 +1,8 @@
 import importlib
 from pathlib import Path
 import sys
+import threading
+import time
 
 import pytest
 
@@ -15,21 +17,28 @@ def app_module(monkeypatch, tmp_path):
     monkeypatch.setenv("ADMIN_USERNAME", "admin")
     monkeypatch.setenv("ADMIN_PASSWORD", "admin-passwort")
     monkeypatch.setenv("DATABASE_URL", f"sqlite:///{tmp_path / 'test.sqlite3'}")
+    monkeypatch.setenv("PAYOUT_RECONCILE_INTERVAL_SECONDS", "0")
 
     backend_root = Path(__file__).resolve().parents[1]
     if str(backend_root) not in sys.path:
         sys.path.insert(0, str(backend_root))
 
     import app as app
+    import app_state as app_state
     import database as database
     import device_registry as device_registry
+    import payments as payments
     import products as products
+    import stripe_client as stripe_client
     import users as users
 
     importlib.reload(database)
     importlib.reload(users)
     importlib.reload(device_registry)
     importlib.reload(products)
+    importlib.reload(payments)
+    importlib.reload(app_state)
+    importlib.reload(stripe_client)
     importlib.reload(app)
     return app
 
@@ -110,6 +119,52 @@ def test_latest_app_version_returns_unavailable_when_missing(client, monkeypatch
     assert response.json == {"available": False}
 
 
+def test_latest_apk_metadata_is_cached_until_directory_changes(client, monkeypatch, tmp_path):
+    test_client, app_module = client
+    monkeypatch.setattr(app_module, "APK_DOWNLOAD_DIR", tmp_path)
+    (tmp_path / "club-payment-1.0.10-release-signed.apk").write_bytes(b"old")
+    scans = []
+    scan_latest_apk = app_module._scan_latest_apk
+
+    def counting_scan(apk_dir):
+        scans.append(apk_dir)
+        return scan_latest_apk(apk_dir)
+
+    monkeypatch.setattr(app_module, "_scan_latest_apk", counting_scan)
+
+    for _ in range(3):
+        assert test_client.get("/api/app/latest").json["version"] == "1.0.10"
+    assert len(scans) == 1
+
+    (tmp_path / "club-payment-1.0.16-release-signed.apk").write_bytes(b"new")
+
+    assert test_client.get("/api/app/latest").json["version"] == "1.0.16"
+    assert len(scans) == 2
+
+
+def test_apk_endpoints_support_conditional_and_range_requests(client, monkeypatch, tmp_path):
+    test_client, app_module = client
+    monkeypatch.setattr(app_module, "APK_DOWNLOAD_DIR", tmp_path)
+    (tmp_path / "club-payment-1.0.15-release-signed.apk").write_bytes(b"0123456789")
+
+    metadata = test_client.get("/api/app/latest")
+    assert metadata.status_code == 200
+    assert metadata.headers["ETag"]
+    not_modified = test_client.get("/api/app/latest", headers={"If-None-Match": metadata.headers["ETag"]})
+    assert not_modified.status_code == 304
+    assert not_modified.data == b""
+
+    download = test_client.get("/apk/latest")
+    etag = download.headers["ETag"]
+    assert download.headers["Accept-Ranges"] == "bytes"
+    assert test_client.get("/apk/latest", headers={"If-None-Match": etag}).status_code == 304
+
+    resumed = test_client.get("/apk/latest", headers={"Range": "bytes=4-", "If-Range": etag})
+    assert resumed.status_code == 206
+    assert resumed.data == b"456789"
+    assert resumed.headers["Content-Range"] == "bytes 4-9/10"
+
+
 def test_connection_token_success(client, monkeypatch):
     test_client, app_module = client
 
@@ -1339,3 +1394,1181 @@ def test_admin_web_payments_refund_rejects_too_large_amount(client, monkeypatch)
 
     assert response.status_code == 200
     assert "Rueckerstattung darf den offenen Betrag nicht ueberschreiten" in response.get_data(as_text=True)
+
+
+def test_token_cache_serves_repeat_requests_and_reports_stats(client):
+    test_client, app_module = client
+    store = app_module.get_user_store()
+    before = store.token_cache_stats()
+
+    for _ in range(3):
+        response = test_client.get("/products", headers={"Authorization": "Bearer admin-token"})
+        assert response.status_code == 200
+
+    stats_response = test_client.get("/admin/stats", headers={"Authorization": "Bearer admin-token"})
+
+    assert stats_response.status_code == 200
+    token_cache = stats_response.get_json()["token_cache"]
+    assert token_cache["misses"] - before["misses"] == 1
+    assert token_cache["hits"] - before["hits"] == 3
+    assert token_cache["size"] == 1
+
+
+def test_token_cache_is_invalidated_when_user_is_updated(client):
+    test_client, app_module = client
+    store = app_module.get_user_store()
+    cashier = store.create_user(
+        name="cache-kasse",
+        role=app_module.Role.KASSIERER,
+        active=True,
+        username="cache-kasse",
+        password_hash=store.hash_password("cache-passwort"),
+    )
+    headers = {"Authorization": f"Bearer {cashier.api_token}"}
+    assert test_client.get("/products", headers=headers).status_code == 200
+
+    store.update_user(user_id=cashier.id, active=False)
+
+    response = test_client.get("/products", headers=headers)
+    assert response.status_code == 401
+
+
+def test_token_lookup_racing_an_update_is_not_cached(app_module, monkeypatch):
+    store = app_module.get_user_store()
+    cashier = store.create_user(name="race-kasse", role=app_module.Role.KASSIERER, active=True)
+    to_user = store._to_user
+    raced = []
+
+    def to_user_racing_update(record):
+        user = to_user(record)
+        if not raced:
+            raced.append(user.id)
+            store.update_user(cashier.id, active=False)
+        return user
+
+    monkeypatch.setattr(store, "_to_user", to_user_racing_update)
+
+    assert store.get_by_token(cashier.api_token).active is True
+    assert store.get_by_token(cashier.api_token).active is False
+
+
+def test_request_reuses_one_database_session_across_stores(client, monkeypatch):
+    test_client, app_module = client
+    import database
+
+    store = app_module.get_user_store()
+    cashier = store.create_user(
+        name="session-kasse",
+        role=app_module.Role.KASSIERER,
+        active=True,
+        username="session-kasse",
+        password_hash=store.hash_password("session-passwort"),
+    )
+    app_module.get_product_store()
+    opened = []
+    session_factory = database.SessionLocal
+
+    def counting_session_factory():
+        session = session_factory()
+        opened.append(session)
+        return session
+
+    monkeypatch.setattr(database, "SessionLocal", counting_session_factory)
+    from sqlalchemy import event
+
+    transactions = []
+
+    def record_begin(conn):
+        transactions.append(conn)
+
+    event.listen(database.engine, "begin", record_begin)
+    try:
+        response = test_client.get("/products", headers={"Authorization": f"Bearer {cashier.api_token}"})
+    finally:
+        event.remove(database.engine, "begin", record_begin)
+
+    assert response.status_code == 200
+    assert len(opened) == 1
+    assert len(transactions) == 1
+
+
+def test_login_releases_database_connection_while_hashing(client, monkeypatch):
+    test_client, app_module = client
+    import database
+    import password_hashing
+
+    checked_out = []
+    verify_password = password_hashing.verify_password
+
+    def recording_verify_password(password_hash, password):
+        checked_out.append(database.engine.pool.checkedout())
+        return verify_password(password_hash, password)
+
+    monkeypatch.setattr(password_hashing, "verify_password", recording_verify_password)
+
+    response = test_client.post("/auth/login", json={"username": "admin", "password": "admin-passwort"})
+
+    assert response.status_code == 200
+    assert checked_out == [0]
+
+
+def test_sqlite_engine_applies_configured_pragmas(app_module, monkeypatch):
+    import database
+
+    monkeypatch.setenv("SQLITE_BUSY_TIMEOUT_MS", "1234")
+    importlib.reload(database)
+
+    with database.engine.connect() as connection:
+        journal_mode = connection.exec_driver_sql("PRAGMA journal_mode").scalar()
+        synchronous = connection.exec_driver_sql("PRAGMA synchronous").scalar()
+        busy_timeout = connection.exec_driver_sql("PRAGMA busy_timeout").scalar()
+
+    assert journal_mode == "wal"
+    assert synchronous == 1
+    assert busy_timeout == 1234
+    assert database.engine.pool.__class__.__name__ == "QueuePool"
+
+
+def test_migrations_add_indexes_to_existing_database(monkeypatch, tmp_path):
+    import sqlite3
+
+    database_path = tmp_path / "legacy.sqlite3"
+    with sqlite3.connect(database_path) as connection:
+        connection.execute(
+            "CREATE TABLE users (id INTEGER PRIMARY KEY, name VARCHAR(255) NOT NULL, role VARCHAR(32) NOT NULL, "
+            "active BOOLEAN NOT NULL, api_token VARCHAR(255) NOT NULL UNIQUE, username VARCHAR(255) UNIQUE, "
+            "password_hash VARCHAR(255))"
+        )
+        connection.execute(
+            "CREATE TABLE products (id INTEGER PRIMARY KEY, name VARCHAR(255) NOT NULL, "
+            "price_cents INTEGER NOT NULL, active BOOLEAN NOT NULL)"
+        )
+    monkeypatch.setenv("DATABASE_URL", f"sqlite:///{database_path}")
+
+    backend_root = Path(__file__).resolve().parents[1]
+    if str(backend_root) not in sys.path:
+        sys.path.insert(0, str(backend_root))
+    import database
+
+    importlib.reload(database)
+    database.init_database()
+
+    with sqlite3.connect(database_path) as connection:
+        indexes = {row[1] for row in connection.execute("SELECT type, name FROM sqlite_master WHERE type = 'index'")}
+        versions = [row[0] for row in connection.execute("SELECT version FROM schema_migrations")]
+
+    assert {"ix_users_role", "ix_products_active", "ix_pending_devices_last_seen_at"} <= indexes
+    assert versions == [1]
+    assert database.run_migrations() == []
+
+
+def test_delete_user_removes_devices_with_set_based_statements(client):
+    test_client, app_module = client
+    import database
+    from sqlalchemy import event
+
+    store = app_module.get_user_store()
+    registry = app_module.get_device_registry()
+    cashier = store.create_user(name="loesch-kasse", role=app_module.Role.KASSIERER, active=True)
+    for index in range(5):
+        registry.assign_device(f"kasse-del-{index}", cashier.id)
+        registry.remember_pending_device(f"neu-del-{index}", user_id=cashier.id, username="loesch-kasse")
+
+    deletes = []
+
+    def record_delete(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("DELETE"):
+            deletes.append(statement)
+
+    event.listen(database.engine, "before_cursor_execute", record_delete)
+    try:
+        response = test_client.delete(
+            f"/admin/users/{cashier.id}",
+            headers={"Authorization": "Bearer admin-token"},
+        )
+    finally:
+        event.remove(database.engine, "before_cursor_execute", record_delete)
+
+    assert response.status_code == 200
+    assert len(deletes) == 3
+    assert store.get_by_id(cashier.id) is None
+    assert all(device.user_id != cashier.id for device in registry.list_devices())
+    assert all(device.user_id != cashier.id for device in registry.list_pending_devices())
+
+
+def test_delete_user_with_devices_respects_foreign_keys(app_module):
+    import database
+    from sqlalchemy import event
+
+    def enable_foreign_keys(dbapi_connection, connection_record):
+        dbapi_connection.execute("PRAGMA foreign_keys=ON")
+
+    event.listen(database.engine, "connect", enable_foreign_keys)
+    database.engine.dispose()
+    try:
+        store = app_module.get_user_store()
+        registry = app_module.get_device_registry()
+        admin = store.get_by_username("admin")
+        registry.assign_device("kasse-fk-admin", admin.id)
+        with pytest.raises(app_module.LastActiveAdminError):
+            store.delete_user(admin.id, delete_devices=True, keep_active_admin=True)
+        assert registry.get_device("kasse-fk-admin").user_id == admin.id
+
+        cashier = store.create_user(name="fk-kasse", role=app_module.Role.KASSIERER, active=True)
+        registry.assign_device("kasse-fk", cashier.id)
+        assert store.delete_user(cashier.id, delete_devices=True, keep_active_admin=True)
+        assert store.get_by_id(cashier.id) is None
+        assert registry.get_device("kasse-fk") is None
+    finally:
+        event.remove(database.engine, "connect", enable_foreign_keys)
+        database.engine.dispose()
+
+
+def test_pending_device_upsert_is_one_statement_and_safe_under_concurrency(app_module):
+    import database
+    from sqlalchemy import event
+
+    registry = app_module.get_device_registry()
+    statements = []
+
+    def record_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(database.engine, "before_cursor_execute", record_statement)
+    try:
+        first = registry.remember_pending_device("kasse-upsert", username="erste")
+    finally:
+        event.remove(database.engine, "before_cursor_execute", record_statement)
+    assert len(statements) == 1
+    assert first.username == "erste"
+
+    errors = []
+
+    def login(index):
+        try:
+            registry.remember_pending_device("kasse-upsert", username=f"kasse-{index}")
+        except Exception as err:  # noqa: BLE001
+            errors.append(err)
+
+    threads = [threading.Thread(target=login, args=(index,)) for index in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert [device.device_id for device in registry.list_pending_devices()] == ["kasse-upsert"]
+
+    assignment = registry.assign_device("kasse-upsert", 1)
+    assert assignment.user_id == 1
+    assert registry.remember_pending_device("kasse-upsert", username="erste") is None
+    assert registry.list_pending_devices() == []
+
+
+def test_pending_device_heartbeats_are_coalesced_until_read(app_module):
+    import database
+    from sqlalchemy import event
+
+    registry = app_module.get_device_registry()
+    assert registry.touch_pending_device("kasse-puls", user_id=1, username="erste") is True
+    first_seen = registry.list_pending_devices()[0].last_seen_at
+
+    writes = []
+
+    def record_write(conn, cursor, statement, parameters, context, executemany):
+        if "pending_devices" in statement and not statement.lstrip().upper().startswith("SELECT"):
+            writes.append(statement)
+
+    event.listen(database.engine, "before_cursor_execute", record_write)
+    try:
+        for index in range(5):
+            assert registry.touch_pending_device("kasse-puls", user_id=1, username=f"puls-{index}") is True
+        assert writes == []
+        pending = registry.list_pending_devices()
+    finally:
+        event.remove(database.engine, "before_cursor_execute", record_write)
+
+    assert len(writes) == 1
+    assert pending[0].username == "puls-4"
+    assert pending[0].last_seen_at >= first_seen
+
+    registry.assign_device("kasse-puls", 1)
+    assert registry.touch_pending_device("kasse-puls", user_id=1, username="erste") is False
+
+
+def test_pending_devices_are_paged_with_keyset_cursor_and_count(app_module):
+    registry = app_module.get_device_registry()
+    for index in range(5):
+        registry.remember_pending_device(f"kasse-seite-{index}", username="seite")
+    registry.remember_pending_device("kasse-zugewiesen", username="seite")
+    import database
+
+    with database.SessionLocal() as session:
+        session.add(database.DeviceAssignmentRecord(device_id="kasse-zugewiesen", user_id=1))
+        session.commit()
+
+    seen = []
+    cursor = None
+    while True:
+        page = registry.page_pending_devices(limit=2, after=cursor)
+        assert page.total == 5
+        seen.extend(device.device_id for device in page.devices)
+        cursor = page.next_cursor
+        if cursor is None:
+            break
+
+    assert sorted(seen) == [f"kasse-seite-{index}" for index in range(5)]
+    assert len(seen) == len(set(seen))
+    assert seen == [device.device_id for device in registry.list_pending_devices()]
+
+
+def test_admin_users_page_query_count_does_not_grow_with_devices(client):
+    test_client, app_module = client
+    import database
+    from sqlalchemy import event
+
+    store = app_module.get_user_store()
+    registry = app_module.get_device_registry()
+    login_response = test_client.post(
+        "/admin/web/login",
+        data={"username": "admin", "password": "admin-passwort"},
+    )
+    assert login_response.status_code == 302
+    assert test_client.get("/admin/web/users").status_code == 200
+
+    def count_page_queries():
+        statements = []
+
+        def record_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(database.engine, "before_cursor_execute", record_statement)
+        try:
+            response = test_client.get("/admin/web/users")
+        finally:
+            event.remove(database.engine, "before_cursor_execute", record_statement)
+        assert response.status_code == 200
+        return len(statements), response.get_data(as_text=True)
+
+    cashier = store.create_user(name="uebersicht", role=app_module.Role.KASSIERER, active=True, username="uebersicht")
+    registry.assign_device("kasse-uebersicht-0", cashier.id)
+    few_devices, _ = count_page_queries()
+
+    for index in range(1, 10):
+        registry.assign_device(f"kasse-uebersicht-{index}", cashier.id)
+    many_devices, body = count_page_queries()
+
+    assert many_devices == few_devices
+    assert "kasse-uebersicht-9" in body
+
+
+def test_admin_devices_supports_cursor_paging_and_field_projection(client):
+    test_client, app_module = client
+    headers = {"Authorization": "Bearer admin-token"}
+    registry = app_module.get_device_registry()
+    for index in range(5):
+        registry.assign_device(f"kasse-flotte-{index}", 1)
+
+    unpaged = test_client.get("/admin/devices", headers=headers).get_json()
+    assert set(unpaged) == {"devices", "pending_devices"}
+    assert unpaged["devices"][0] == {
+        "device_id": "kasse-flotte-0",
+        "user_id": 1,
+        "name": "admin",
+        "username": "admin",
+        "role": "admin",
+        "active": True,
+    }
+
+    seen = []
+    after = None
+    while True:
+        query = {"limit": 2, "fields": "device_id,role"}
+        if after:
+            query["after"] = after
+        page = test_client.get("/admin/devices", query_string=query, headers=headers).get_json()
+        assert all(set(device) == {"device_id", "role"} for device in page["devices"])
+        seen.extend(device["device_id"] for device in page["devices"])
+        after = page["next_after"]
+        if after is None:
+            break
+
+    assert seen == [device["device_id"] for device in unpaged["devices"]]
+    assert test_client.get("/admin/devices?limit=0", headers=headers).status_code == 400
+    assert test_client.get("/admin/devices?fields=secret", headers=headers).status_code == 400
+
+
+def test_concurrent_admin_demotions_keep_one_active_admin(app_module):
+    store = app_module.get_user_store()
+    second_admin = store.create_user(name="zweiter-admin", role=app_module.Role.ADMIN, active=True)
+    admin_ids = [user.id for user in store.list_users() if user.role == app_module.Role.ADMIN]
+    assert store.count_active_admins() == 2
+
+    barrier = threading.Barrier(len(admin_ids))
+    outcomes = []
+
+    def demote(user_id):
+        barrier.wait()
+        try:
+            store.update_user(user_id=user_id, active=False, keep_active_admin=True)
+            outcomes.append("ok")
+        except app_module.LastActiveAdminError:
+            outcomes.append("blocked")
+
+    threads = [threading.Thread(target=demote, args=(user_id,)) for user_id in admin_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(outcomes) == ["blocked", "ok"]
+    assert store.count_active_admins() == 1
+    with pytest.raises(app_module.LastActiveAdminError):
+        remaining = next(user for user in store.list_users() if user.active and user.role == app_module.Role.ADMIN)
+        store.delete_user(remaining.id, keep_active_admin=True)
+    assert store.get_by_id(second_admin.id) is not None
+
+
+def test_login_returns_503_when_password_hash_pool_is_full(client, monkeypatch):
+    test_client, app_module = client
+    import password_hashing
+
+    executor = password_hashing.PasswordHashExecutor(workers=1, queue_size=0, timeout_seconds=5)
+    monkeypatch.setattr(password_hashing, "_EXECUTOR", executor)
+    release = threading.Event()
+    blocker = threading.Thread(target=executor.run, args=(release.wait,))
+    blocker.start()
+    deadline = time.monotonic() + 5
+    while executor.stats()["in_flight"] == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    try:
+        response = test_client.post("/auth/login", json={"username": "admin", "password": "admin-passwort"})
+    finally:
+        release.set()
+        blocker.join()
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    assert executor.stats()["rejected"] == 1
+    ok_response = test_client.post("/auth/login", json={"username": "admin", "password": "admin-passwort"})
+    assert ok_response.status_code == 200
+
+
+def test_authenticate_rehashes_outdated_password_hash(app_module, monkeypatch):
+    import password_hashing
+    from werkzeug.security import generate_password_hash
+
+    monkeypatch.setattr(password_hashing, "PASSWORD_HASH_METHOD", "pbkdf2:sha256:2000")
+    store = app_module.get_user_store()
+    user = store.create_user(
+        name="alt-hash",
+        role=app_module.Role.KASSIERER,
+        active=True,
+        username="alt-hash",
+        password_hash=generate_password_hash("alt-passwort", method="pbkdf2:sha256:1000"),
+    )
+
+    assert store.authenticate("alt-hash", "falsch") is None
+    assert store.get_by_id(user.id).password_hash.startswith("pbkdf2:sha256:1000$")
+
+    authenticated = store.authenticate("alt-hash", "alt-passwort")
+
+    assert authenticated.password_hash.startswith("pbkdf2:sha256:2000$")
+    assert store.get_by_id(user.id).password_hash == authenticated.password_hash
+    assert store.authenticate("alt-hash", "alt-passwort") is not None
+
+
+def test_invalid_password_hash_method_fails_at_import(app_module, monkeypatch):
+    import password_hashing
+
+    monkeypatch.setenv("PASSWORD_HASH_METHOD", "scrypt:abc")
+    try:
+        with pytest.raises(RuntimeError, match="PASSWORD_HASH_METHOD"):
+            importlib.reload(password_hashing)
+    finally:
+        monkeypatch.delenv("PASSWORD_HASH_METHOD")
+        importlib.reload(password_hashing)
+
+
+def test_calibrate_password_hash_command_prints_method(app_module):
+    result = app_module.app.test_cli_runner().invoke(
+        args=["calibrate-password-hash", "--target-ms", "1", "--algorithm", "pbkdf2"]
+    )
+
+    assert result.exit_code == 0
+    assert result.output.startswith("PASSWORD_HASH_METHOD=pbkdf2:sha256:")
+
+
+def test_login_throttle_rejects_excess_attempts_before_hashing(client, monkeypatch):
+    test_client, app_module = client
+    from login_throttle import LoginThrottle
+
+    monkeypatch.setattr(app_module, "_LOGIN_THROTTLE", LoginThrottle(burst=2, refill_per_minute=1))
+    store = app_module.get_user_store()
+    verified = []
+    authenticate = store.authenticate
+
+    def counting_authenticate(username, password):
+        verified.append(username)
+        return authenticate(username, password)
+
+    monkeypatch.setattr(store, "authenticate", counting_authenticate)
+
+    statuses = [
+        test_client.post("/auth/login", json={"username": "admin", "password": "falsch"}).status_code
+        for _ in range(3)
+    ]
+    throttled = test_client.post("/auth/login", json={"username": "Admin", "password": "admin-passwort"})
+
+    assert statuses == [401, 401, 429]
+    assert throttled.status_code == 429
+    assert int(throttled.headers["Retry-After"]) >= 1
+    assert len(verified) == 2
+    stats = test_client.get("/admin/stats", headers={"Authorization": "Bearer admin-token"}).get_json()
+    assert stats["login_throttle"]["rejected"] == {"username": 2, "address": 2}
+
+
+def test_login_throttle_lets_many_cashiers_log_in_from_one_address(client, monkeypatch):
+    test_client, app_module = client
+    from login_throttle import LoginThrottle
+
+    monkeypatch.setattr(app_module, "_LOGIN_THROTTLE", LoginThrottle(burst=5, refill_per_minute=1))
+    store = app_module.get_user_store()
+    password_hash = store.hash_password("kasse-passwort")
+    for index in range(8):
+        store.create_user(
+            name=f"schicht-{index}",
+            role=app_module.Role.KASSIERER,
+            active=True,
+            username=f"schicht-{index}",
+            password_hash=password_hash,
+        )
+
+    statuses = [
+        test_client.post("/auth/login", json={"username": f"schicht-{index}", "password": "kasse-passwort"}).status_code
+        for index in range(8)
+    ]
+    assert statuses == [200] * 8
+
+    guesses = [
+        test_client.post("/auth/login", json={"username": f"schicht-{index}", "password": "falsch"}).status_code
+        for index in range(6)
+    ]
+    assert guesses == [401] * 5 + [429]
+
+
+def test_login_throttle_refills_and_sweeps_idle_buckets(app_module):
+    from login_throttle import LoginThrottle
+
+    now = [0.0]
+    throttle = LoginThrottle(burst=1, refill_per_minute=60, clock=lambda: now[0])
+
+    assert throttle.acquire([("username", "kasse")]) == 0.0
+    assert throttle.acquire([("username", "kasse")]) == 1.0
+    now[0] = 1.0
+    assert throttle.acquire([("username", "kasse")]) == 0.0
+    assert throttle.stats()["tracked_keys"] == 1
+
+    now[0] = 5.0
+    assert throttle.acquire([("username", "andere")]) == 0.0
+    assert throttle.stats()["tracked_keys"] == 1
+
+
+def test_unknown_tokens_are_answered_from_negative_cache_until_user_created(client):
+    test_client, app_module = client
+    store = app_module.get_user_store()
+    headers = {"Authorization": "Bearer neues-token"}
+    before = store.unknown_token_cache_stats()
+
+    for _ in range(3):
+        assert test_client.get("/products", headers=headers).status_code == 401
+    stats = store.unknown_token_cache_stats()
+    assert stats["misses"] - before["misses"] == 1
+    assert stats["hits"] - before["hits"] == 2
+
+    store.create_user(name="neu", role=app_module.Role.KASSIERER, active=True, api_token="neues-token")
+
+    assert test_client.get("/products", headers=headers).status_code == 200
+    assert store.unknown_token_cache_stats()["size"] == 0
+
+
+def _post_webhook_event(test_client, app_module, monkeypatch, event_type, obj):
+    event = {"id": f"evt_{event_type}", "type": event_type, "created": 1710000000, "data": {"object": obj}}
+    monkeypatch.setattr(
+        app_module.stripe.Webhook,
+        "construct_event",
+        staticmethod(lambda payload, sig_header, secret: event),
+    )
+    return test_client.post("/webhook", data=b"{}", headers={"Stripe-Signature": "valid"})
+
+
+def _ledger_intent(**overrides):
+    intent = {
+        "id": "pi_ledger",
+        "created": 1710000000,
+        "status": "succeeded",
+        "amount": 500,
+        "currency": "eur",
+        "metadata": {"club": "DARC e.V. OV L11", "item": "Mate", "kassierer": "admin", "device": "kasse-1"},
+        "latest_charge": {
+            "id": "ch_ledger",
+            "amount": 500,
+            "amount_refunded": 0,
+            "refunded": False,
+            "receipt_url": "https://pay.stripe.com/receipts/ledger",
+            "balance_transaction": {"id": "txn_ledger", "status": "pending", "available_on": 1710086400},
+        },
+    }
+    intent.update(overrides)
+    return intent
+
+
+def test_webhook_keeps_payment_ledger_for_admin_page(client, monkeypatch, tmp_path):
+    test_client, app_module = client
+    monkeypatch.chdir(tmp_path)
+
+    response = _post_webhook_event(test_client, app_module, monkeypatch, "payment_intent.succeeded", _ledger_intent())
+    assert response.status_code == 200
+    app_module.get_app_state_store().set(app_module.PAYMENT_SYNC_HIGH_WATER_KEY, "1710000000")
+
+    def fail_list(**kwargs):
+        raise AssertionError("admin page must read from the payment ledger")
+
+    monkeypatch.setattr(app_module.stripe.PaymentIntent, "list", staticmethod(fail_list))
+    test_client.post("/admin/web/login", data={"username": "admin", "password": "admin-passwort"})
+
+    page = test_client.get("/admin/web/payments").get_data(as_text=True)
+
+    assert "pi_ledger" in page
+    assert "Mate" in page
+    assert "kasse-1" in page
+    assert "noch nicht auszahlbar" in page
+
+
+def test_admin_page_stays_live_until_ledger_backfill_completes(client, monkeypatch, tmp_path):
+    test_client, app_module = client
+    monkeypatch.chdir(tmp_path)
+    history = [_ledger_intent(id=f"pi_alt_{index}", created=1700000000 + index) for index in range(4)]
+    monkeypatch.setattr(
+        app_module.stripe.PaymentIntent,
+        "list",
+        staticmethod(lambda **kwargs: {"data": [_ledger_intent(), *history], "has_more": False}),
+    )
+    test_client.post("/admin/web/login", data={"username": "admin", "password": "admin-passwort"})
+
+    _post_webhook_event(test_client, app_module, monkeypatch, "payment_intent.succeeded", _ledger_intent())
+    app_module._ADMIN_PAYMENTS_CACHE.invalidate()
+    before_backfill = test_client.get("/admin/web/payments").get_data(as_text=True)
+
+    assert "pi_alt_3" in before_backfill
+
+    app_module._sync_payments_from_stripe()
+    app_module._ADMIN_PAYMENTS_CACHE.invalidate()
+    monkeypatch.setattr(
+        app_module.stripe.PaymentIntent,
+        "list",
+        staticmethod(lambda **kwargs: pytest.fail("admin page must read from the payment ledger")),
+    )
+    after_backfill = test_client.get("/admin/web/payments").get_data(as_text=True)
+
+    assert "pi_alt_3" in after_backfill
+    assert "pi_ledger" in after_backfill
+
+
+def test_webhook_charge_refund_updates_ledger_for_refund_checks(client, monkeypatch, tmp_path):
+    test_client, app_module = client
+    monkeypatch.chdir(tmp_path)
+    _post_webhook_event(test_client, app_module, monkeypatch, "payment_intent.succeeded", _ledger_intent())
+
+    response = _post_webhook_event(test_client, app_module, monkeypatch, "charge.refunded", {
+        "id": "ch_ledger",
+        "payment_intent": "pi_ledger",
+        "amount": 500,
+        "amount_refunded": 200,
+        "refunded": False,
+        "receipt_url": "https://pay.stripe.com/receipts/ledger",
+        "balance_transaction": "txn_ledger",
+    })
+    assert response.status_code == 200
+
+    def fail_retrieve(*args, **kwargs):
+        raise AssertionError("refund pre-check must read from the payment ledger")
+
+    monkeypatch.setattr(app_module.stripe.PaymentIntent, "retrieve", staticmethod(fail_retrieve))
+    test_client.post("/admin/web/login", data={"username": "admin", "password": "admin-passwort"})
+
+    response = test_client.post(
+        "/admin/web/payments",
+        data={"action": "refund", "payment_intent_id": "pi_ledger", "refund_amount": "3,01"},
+    )
+
+    assert response.status_code == 200
+    assert "Rueckerstattung darf den offenen Betrag nicht ueberschreiten" in response.get_data(as_text=True)
+    payment = app_module.get_payment_store().get_payment("pi_ledger")
+    assert payment.amount_refunded_cents == 200
+    assert payment.refundable_cents == 300
+
+
+def test_refund_stores_absolute_refunded_amount_and_ignores_stale_events(client, monkeypatch):
+    _, app_module = client
+    ledger = app_module.get_payment_store()
+    ledger.upsert_payment(
+        "pi_ledger",
+        {"status": "succeeded", "amount_cents": 500, "amount_refunded_cents": 0, "charge_id": "ch_ledger"},
+    )
+    refunded_charge = {"id": "ch_ledger", "payment_intent": "pi_ledger", "amount": 500, "amount_refunded": 200}
+
+    def fake_refund_create(**kwargs):
+        # The charge.refunded webhook lands before Refund.create returns.
+        app_module._handle_charge_event(refunded_charge)
+        return {"id": "re_1", "charge": "ch_ledger"}
+
+    monkeypatch.setattr(app_module.stripe.Refund, "create", staticmethod(fake_refund_create))
+    monkeypatch.setattr(app_module.stripe.Charge, "retrieve", staticmethod(lambda charge_id: refunded_charge))
+
+    assert app_module._refund_payment_intent("pi_ledger", "2,00") == 200
+    assert ledger.get_payment("pi_ledger").amount_refunded_cents == 200
+
+    app_module._handle_charge_event({**refunded_charge, "amount_refunded": 0})
+    payment = ledger.get_payment("pi_ledger")
+    assert payment.amount_refunded_cents == 200
+    assert payment.refundable_cents == 300
+
+
+def test_webhook_payout_event_links_ledger_payments(client, monkeypatch, tmp_path):
+    test_client, app_module = client
+    monkeypatch.chdir(tmp_path)
+    _post_webhook_event(test_client, app_module, monkeypatch, "payment_intent.succeeded", _ledger_intent())
+
+    class DummyBalanceTransactions:
+        def auto_paging_iter(self):
+            return iter([{"id": "txn_ledger", "source": "ch_ledger"}])
+
+    def fake_list(**kwargs):
+        assert kwargs["payout"] == "po_ledger"
+        return DummyBalanceTransactions()
+
+    monkeypatch.setattr(app_module.stripe.BalanceTransaction, "list", staticmethod(fake_list))
+
+    response = _post_webhook_event(test_client, app_module, monkeypatch, "payout.paid", {
+        "id": "po_ledger",
+        "status": "paid",
+        "arrival_date": 1710172800,
+    })
+
+    assert response.status_code == 200
+    payment = app_module.get_payment_store().get_payment("pi_ledger")
+    assert payment.payout_id == "po_ledger"
+    assert payment.payout_label == "ausgezahlt"
+    assert payment.payout_detail == "po_ledger / Ankunft 11.03.2024"
+
+
+def test_payment_sync_pages_history_and_resumes_from_high_water_mark(client, monkeypatch):
+    _, app_module = client
+    monkeypatch.setattr(app_module, "PAYMENT_SYNC_LOOKBACK_SECONDS", 60)
+    pages = {
+        None: {"data": [_ledger_intent(id="pi_new", created=1710000300)], "has_more": True},
+        "pi_new": {"data": [_ledger_intent(id="pi_old", created=1710000000)], "has_more": False},
+    }
+    calls = []
+
+    def fake_list(**kwargs):
+        calls.append(kwargs)
+        return pages[kwargs.get("starting_after")]
+
+    monkeypatch.setattr(app_module.stripe.PaymentIntent, "list", staticmethod(fake_list))
+
+    result = app_module.app.test_cli_runner().invoke(args=["sync-payments"])
+
+    assert result.exit_code == 0
+    assert "2 Zahlungen synchronisiert" in result.output
+    assert [call.get("starting_after") for call in calls] == [None, "pi_new"]
+    assert "created" not in calls[0]
+    ledger = app_module.get_payment_store()
+    assert [payment.id for payment in ledger.list_successful_payments()] == ["pi_new", "pi_old"]
+    assert app_module.get_app_state_store().get(app_module.PAYMENT_SYNC_HIGH_WATER_KEY) == "1710000300"
+
+    calls.clear()
+    pages[None] = {"data": [_ledger_intent(id="pi_new", created=1710000300)], "has_more": False}
+
+    assert app_module._sync_payments_from_stripe() == 0
+    assert calls[0]["created"] == {"gte": 1710000240}
+
+
+def test_payment_sync_keeps_ledger_row_when_charge_lookup_fails(client, monkeypatch):
+    _, app_module = client
+    ledger = app_module.get_payment_store()
+    ledger.upsert_payment(
+        "pi_ledger",
+        {"status": "succeeded", "amount_cents": 500, "amount_refunded_cents": 200, "charge_id": "ch_ledger"},
+    )
+
+    def failing_charge_retrieve(charge_id):
+        raise app_module.stripe.error.APIConnectionError("timeout")
+
+    intent = _ledger_intent(latest_charge="ch_ledger")
+    newer_intent = _ledger_intent(id="pi_newer", created=intent["created"] + 300)
+    monkeypatch.setattr(
+        app_module.stripe.PaymentIntent,
+        "list",
+        staticmethod(lambda **kwargs: {"data": [newer_intent, intent], "has_more": False}),
+    )
+    monkeypatch.setattr(app_module.stripe.Charge, "retrieve", staticmethod(failing_charge_retrieve))
+
+    assert app_module._sync_payments_from_stripe() == 1
+    payment = ledger.get_payment("pi_ledger")
+    assert payment.amount_refunded_cents == 200
+    assert payment.charge_id == "ch_ledger"
+    state = app_module.get_app_state_store()
+    assert state.get(app_module.PAYMENT_SYNC_HIGH_WATER_KEY) == str(intent["created"])
+
+
+def test_empty_ledger_page_shows_live_page_without_backfill(client, monkeypatch):
+    test_client, app_module = client
+    calls = []
+
+    def fake_list(**kwargs):
+        calls.append(kwargs)
+        return {"data": [_ledger_intent()], "has_more": True}
+
+    monkeypatch.setattr(app_module.stripe.PaymentIntent, "list", staticmethod(fake_list))
+    test_client.post("/admin/web/login", data={"username": "admin", "password": "admin-passwort"})
+
+    response = test_client.get("/admin/web/payments")
+
+    assert response.status_code == 200
+    assert "Mate" in response.get_data(as_text=True)
+    assert len(calls) == 1
+    assert not app_module.get_payment_store().has_payments()
+
+    monkeypatch.setenv("PAYMENT_SYNC_INTERVAL_SECONDS", "60")
+    importlib.reload(app_module)
+    assert "payment-sync" not in {thread.name for thread in threading.enumerate()}
+
+
+def test_payout_reconciliation_indexes_charges_in_bulk(client, monkeypatch):
+    test_client, app_module = client
+    monkeypatch.setattr(app_module, "WEBHOOK_SECRET", None)
+    monkeypatch.setattr(app_module, "PAYOUT_RECONCILE_INTERVAL_SECONDS", 300)
+    intents = [
+        _ledger_intent(id=f"pi_{index}", latest_charge={
+            "id": f"ch_{index}",
+            "amount": 500,
+            "amount_refunded": 0,
+            "balance_transaction": {"id": f"txn_{index}", "payout": "po_batch"},
+        })
+        for index in range(5)
+    ]
+    calls = {"payout_list": 0, "balance_transaction_list": 0}
+
+    class DummyBalanceTransactions:
+        def auto_paging_iter(self):
+            return iter([{"id": f"txn_{index}", "source": f"ch_{index}"} for index in range(5)])
+
+    def fake_payout_list(**kwargs):
+        calls["payout_list"] += 1
+        return {"data": [{"id": "po_batch", "status": "paid", "arrival_date": 1710172800}]}
+
+    def fake_balance_transaction_list(**kwargs):
+        calls["balance_transaction_list"] += 1
+        assert kwargs["payout"] == "po_batch"
+        return DummyBalanceTransactions()
+
+    def fail_retrieve(*args, **kwargs):
+        raise AssertionError("indexed payouts must not be retrieved per charge")
+
+    monkeypatch.setattr(app_module.stripe.PaymentIntent, "list", staticmethod(lambda **kwargs: {"data": intents}))
+    monkeypatch.setattr(app_module.stripe.Payout, "list", staticmethod(fake_payout_list))
+    monkeypatch.setattr(app_module.stripe.BalanceTransaction, "list", staticmethod(fake_balance_transaction_list))
+    monkeypatch.setattr(app_module.stripe.Payout, "retrieve", staticmethod(fail_retrieve))
+    test_client.post("/admin/web/login", data={"username": "admin", "password": "admin-passwort"})
+
+    first_page = test_client.get("/admin/web/payments").get_data(as_text=True)
+    second_page = test_client.get("/admin/web/payments").get_data(as_text=True)
+
+    assert first_page.count("po_batch / Ankunft 11.03.2024") == 5
+    assert second_page.count("po_batch / Ankunft 11.03.2024") == 5
+    assert calls == {"payout_list": 1, "balance_transaction_list": 1}
+
+
+def test_stale_while_revalidate_cache_serves_stale_value_while_refreshing(client):
+    _, app_module = client
+    now = [100.0]
+    loads = []
+
+    def loader():
+        loads.append(now[0])
+        return len(loads)
+
+    cache = app_module.StaleWhileRevalidateCache(loader, ttl_seconds=10, clock=lambda: now[0])
+
+    assert cache.get()[0] == 1
+    now[0] = 105.0
+    assert cache.get()[0] == 1
+    now[0] = 111.0
+    assert cache.get()[0] == 1
+
+    deadline = time.monotonic() + 2
+    while cache.get()[0] != 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert cache.get()[0] == 2
+
+    cache.invalidate()
+    assert cache.get()[0] == 3
+    assert len(loads) == 3
+
+
+def test_admin_payments_page_is_cached_until_refund(client, monkeypatch):
+    test_client, app_module = client
+    monkeypatch.setattr(app_module, "WEBHOOK_SECRET", None)
+    calls = {"list": 0}
+
+    def fake_list(**kwargs):
+        calls["list"] += 1
+        return {"data": [_ledger_intent()]}
+
+    monkeypatch.setattr(app_module.stripe.PaymentIntent, "list", staticmethod(fake_list))
+    monkeypatch.setattr(app_module.stripe.PaymentIntent, "retrieve", staticmethod(lambda *args, **kwargs: _ledger_intent()))
+    monkeypatch.setattr(app_module.stripe.Refund, "create", staticmethod(lambda **kwargs: object()))
+    test_client.post("/admin/web/login", data={"username": "admin", "password": "admin-passwort"})
+
+    first_page = test_client.get("/admin/web/payments").get_data(as_text=True)
+    test_client.get("/admin/web/payments")
+
+    assert "Stand: gerade eben" in first_page
+    assert calls["list"] == 1
+
+    test_client.post(
+        "/admin/web/payments",
+        data={"action": "refund", "payment_intent_id": "pi_ledger", "refund_amount": "1,00"},
+        follow_redirects=True,
+    )
+
+    assert calls["list"] == 2
+
+
+def test_unexpanded_charges_are_retrieved_concurrently_within_deadline(client, monkeypatch):
+    test_client, app_module = client
+    monkeypatch.setattr(app_module, "WEBHOOK_SECRET", None)
+    monkeypatch.setattr(app_module, "STRIPE_PREFETCH_DEADLINE_SECONDS", 0.5)
+    intents = [_ledger_intent(id=f"pi_{index}", latest_charge=f"ch_{index}") for index in range(6)]
+    intents.append(_ledger_intent(id="pi_slow", latest_charge="ch_slow"))
+    state = {"active": 0, "max_active": 0, "threads": set()}
+    lock = threading.Lock()
+
+    def fake_charge_retrieve(charge_id):
+        with lock:
+            state["threads"].add(threading.current_thread().name)
+            state["active"] += 1
+            state["max_active"] = max(state["max_active"], state["active"])
+        time.sleep(2 if charge_id == "ch_slow" else 0.1)
+        with lock:
+            state["active"] -= 1
+        return {"id": charge_id, "amount": 500, "amount_refunded": 0, "balance_transaction": None}
+
+    monkeypatch.setattr(app_module.stripe.PaymentIntent, "list", staticmethod(lambda **kwargs: {"data": intents}))
+    monkeypatch.setattr(app_module.stripe.Charge, "retrieve", staticmethod(fake_charge_retrieve))
+
+    started = time.monotonic()
+    payments = app_module._list_successful_admin_payments()
+    elapsed = time.monotonic() - started
+
+    assert elapsed < 1.5
+    assert state["max_active"] > 1
+    by_id = {payment["id"]: payment for payment in payments}
+    assert by_id["pi_0"]["charge_id"] == "ch_0"
+    assert by_id["pi_slow"]["details_unavailable"] is True
+    assert by_id["pi_slow"]["charge_id"] == "ch_slow"
+    assert by_id["pi_slow"]["refundable_cents"] == 0
+    assert by_id["pi_slow"]["payout_label"] == "Status unbekannt"
+
+    test_client.post("/admin/web/login", data={"username": "admin", "password": "admin-passwort"})
+    page = test_client.get("/admin/web/payments").get_data(as_text=True)
+    assert "Fuer 1 Zahlung(en) konnten die Details nicht von Stripe geladen werden" in page
+    assert page.count('name="payment_intent_id"') == 6
+    assert all(name.startswith("stripe-prefetch") for name in state["threads"])
+    assert len(state["threads"]) <= min(app_module.STRIPE_PREFETCH_WORKERS, app_module.STRIPE_HTTP_POOL_SIZE)
+
+
+def test_stripe_uses_pooled_http_client_with_timeouts_and_retries(app_module, monkeypatch):
+    import stripe_client
+
+    monkeypatch.setenv("STRIPE_CONNECT_TIMEOUT_SECONDS", "3")
+    monkeypatch.setenv("STRIPE_READ_TIMEOUT_SECONDS", "12")
+    monkeypatch.setenv("STRIPE_MAX_NETWORK_RETRIES", "4")
+    monkeypatch.setenv("STRIPE_HTTP_POOL_SIZE", "6")
+    importlib.reload(stripe_client)
+
+    stripe_client.configure_stripe("sk_test_pool", api_version="2024-06-20")
+
+    stripe = app_module.stripe
+    http_client = stripe.default_http_client
+    assert stripe.api_key == "sk_test_pool"
+    assert stripe.max_network_retries == 4
+    assert isinstance(http_client, stripe.RequestsClient)
+    assert http_client._timeout == (3.0, 12.0)
+    assert http_client._session.get_adapter("https://api.stripe.com")._pool_maxsize == 6
+
+
+def test_stripe_calls_do_not_pin_a_database_connection(client, monkeypatch):
+    test_client, app_module = client
+    import database
+
+    test_client.post(
+        "/admin/devices",
+        json={"device_id": "kasse-pool", "user_id": 1},
+        headers={"Authorization": "Bearer admin-token"},
+    )
+    checked_out = []
+
+    def fake_http_request(self, method, url, headers, post_data=None):
+        checked_out.append(database.engine.pool.checkedout())
+        body = b'{"id": "pi_pool", "object": "payment_intent", "client_secret": "secret_pool", "amount": 500}'
+        return body, 200, {}
+
+    monkeypatch.setattr(app_module.stripe.RequestsClient, "request", fake_http_request)
+
+    response = test_client.post(
+        "/pos/create_intent",
+        json={"amount_cents": 500, "item": "Cola", "device": "kasse-pool"},
+        headers={"Authorization": "Bearer admin-token"},
+    )
+
+    assert response.status_code == 200
+    assert response.get_json()["id"] == "pi_pool"
+    assert checked_out == [0]
+
+
+def test_payment_sync_job_uses_a_fresh_session_per_round(app_module, monkeypatch):
+    from flask import g
+
+    sessions = []
+
+    class StopJob(Exception):
+        pass
+
+    def fake_sync():
+        app_module.get_payment_store().has_payments()
+        sessions.append(g.db_session)
+        return 0
+
+    def fake_sleep(seconds):
+        if len(sessions) >= 2:
+            raise StopJob()
+
+    monkeypatch.setattr(app_module, "_sync_payments_from_stripe", fake_sync)
+    monkeypatch.setattr(app_module.time, "sleep", fake_sleep)
+
+    with app_module.app.app_context():
+        with pytest.raises(StopJob):
+            app_module._run_payment_sync_job()
+        assert "db_session" not in g
+    assert len(sessions) == 2
+    assert sessions[0] is not sessions[1]
+
+
+def test_terminal_location_is_resolved_once_and_persisted(client, monkeypatch):
+    test_client, app_module = client
+    monkeypatch.setattr(app_module, "STRIPE_LOCATION_ID", "")
+    calls = {"list": 0, "create": 0}
+
+    class EmptyLocations:
+        data = []
+
+    class CreatedLocation:
+        id = "tml_once"
+
+    def fake_list(limit):
+        calls["list"] += 1
+        time.sleep(0.05)
+        return EmptyLocations()
+
+    def fake_create(**kwargs):
+        calls["create"] += 1
+        return CreatedLocation()
+
+    monkeypatch.setattr(app_module.stripe.terminal.Location, "list", staticmethod(fake_list))
+    monkeypatch.setattr(app_module.stripe.terminal.Location, "create", staticmethod(fake_create))
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(app_module._resolve_terminal_location_id()))
+        for _ in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == ["tml_once"] * 5
+    assert calls == {"list": 1, "create": 1}
+
+    monkeypatch.setattr(app_module, "_TERMINAL_LOCATION_ID", None)
+    response = test_client.get("/terminal/config", headers={"Authorization": "Bearer admin-token"})
+    assert response.get_json() == {"location_id": "tml_once"}
+    assert calls == {"list": 1, "create": 1}
+
+    refresh_response = test_client.post(
+        "/terminal/config/refresh",
+        headers={"Authorization": "Bearer admin-token"},
+    )
+    assert refresh_response.status_code == 200
+    assert calls == {"list": 2, "create": 2}
+
+
+def test_admin_pages_use_session_user_snapshot_until_user_changes(client, monkeypatch):
+    test_client, app_module = client
+    store = app_module.get_user_store()
+    login_response = test_client.post(
+        "/admin/web/login",
+        data={"username": "admin", "password": "admin-passwort"},
+    )
+    assert login_response.status_code == 302
+    assert test_client.get("/admin/web/users").status_code == 200
+
+    lookups = []
+    original_get_by_id = store.get_by_id
+
+    def counting_get_by_id(user_id):
+        lookups.append(user_id)
+        return original_get_by_id(user_id)
+
+    monkeypatch.setattr(store, "get_by_id", counting_get_by_id)
+
+    for _ in range(2):
+        assert test_client.get("/admin/web/users").status_code == 200
+    assert lookups == []
+
+    admin = store.get_by_username("admin")
+    store.update_user(admin.id, active=False)
+
+    response = test_client.get("/admin/web/users")
+    assert response.status_code == 302
+    assert response.headers["Location"].endswith("/admin/web/login")
+    assert lookups == [admin.id]
+    with test_client.session_transaction() as web_session:
+        assert "admin_user" not in web_session
+
+
+def test_web_user_lookup_racing_an_update_is_not_cached(client, monkeypatch):
+    test_client, app_module = client
+    store = app_module.get_user_store()
+    test_client.post("/admin/web/login", data={"username": "admin", "password": "admin-passwort"})
+    get_by_id = store.get_by_id
+    raced = []
+
+    def get_by_id_racing_update(user_id):
+        user = get_by_id(user_id)
+        if not raced:
+            raced.append(user_id)
+            store.update_user(user_id, active=False)
+        return user
+
+    monkeypatch.setattr(store, "get_by_id", get_by_id_racing_update)
+
+    assert test_client.get("/admin/web/users").status_code == 200
+    response = test_client.get("/admin/web/users")
+
+    assert response.status_code == 302
+    assert response.headers["Location"].endswith("/admin/web/login")
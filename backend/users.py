@@ -1,15 +1,32 @@
 from __future__ import annotations
 
+import hashlib
 import os
 import secrets
+import threading
 from getpass import getpass
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 from enum import Enum
-from typing import Iterable, Optional
+from typing import Dict, Iterable, Optional
 
-from werkzeug.security import check_password_hash, generate_password_hash
+from sqlalchemy import delete, func, select, update
 
-from database import SessionLocal, UserRecord, init_database
+import password_hashing
+from cache import TTLCache
+from database import (
+    DeviceAssignmentRecord,
+    PendingDeviceRecord,
+    UserRecord,
+    end_request_transaction,
+    init_database,
+    session_scope,
+)
+from errors import ServiceBusyError
+
+AUTH_TOKEN_CACHE_TTL_SECONDS = float(os.getenv("AUTH_TOKEN_CACHE_TTL_SECONDS", "30"))
+AUTH_TOKEN_CACHE_SIZE = int(os.getenv("AUTH_TOKEN_CACHE_SIZE", "512"))
+AUTH_NEGATIVE_TOKEN_CACHE_TTL_SECONDS = float(os.getenv("AUTH_NEGATIVE_TOKEN_CACHE_TTL_SECONDS", "10"))
+AUTH_NEGATIVE_TOKEN_CACHE_SIZE = int(os.getenv("AUTH_NEGATIVE_TOKEN_CACHE_SIZE", "1024"))
 
 
 class Role(str, Enum):
@@ -28,21 +45,75 @@ class User:
     password_hash: Optional[str] = None
 
 
+@dataclass(frozen=True)
+class UserSnapshot:
+    id: int
+    name: str
+    role: Role
+    active: bool
+    username: Optional[str] = None
+
+
+def user_from_record(record: UserRecord) -> User:
+    return User(
+        id=record.id,
+        name=record.name,
+        role=Role(record.role),
+        active=record.active,
+        api_token=record.api_token,
+        username=record.username,
+        password_hash=record.password_hash,
+    )
+
+
+class LastActiveAdminError(Exception):
+    pass
+
+
 class UserStore:
+    def __init__(self) -> None:
+        self._token_cache = TTLCache(maxsize=AUTH_TOKEN_CACHE_SIZE, ttl_seconds=AUTH_TOKEN_CACHE_TTL_SECONDS)
+        # Keyed by digest so rejected tokens cost a fixed 32 bytes and are not kept in clear text.
+        self._unknown_token_cache = TTLCache(
+            maxsize=AUTH_NEGATIVE_TOKEN_CACHE_SIZE,
+            ttl_seconds=AUTH_NEGATIVE_TOKEN_CACHE_TTL_SECONDS,
+        )
+        # Bumped on every create/update/delete; a lookup that raced one of them is not cached.
+        self._token_generation = 0
+        self._token_lock = threading.Lock()
+        # Versions live in this process only; the epoch makes stamps from another process never match.
+        self._version_epoch = secrets.token_hex(8)
+        self._version_lock = threading.Lock()
+        self._user_versions: Dict[int, int] = {}
+
+    def _invalidate_cached_user(self, user_id: int) -> None:
+        with self._token_lock:
+            self._token_generation += 1
+            self._token_cache.discard_where(lambda _token, user: user.id == user_id)
+        with self._version_lock:
+            self._user_versions[user_id] = self._user_versions.get(user_id, 0) + 1
+
+    def user_version(self, user_id: int) -> str:
+        with self._version_lock:
+            return f"{self._version_epoch}:{self._user_versions.get(user_id, 0)}"
+
+    def _cache_token_lookup(self, generation: int, cache: TTLCache, key, value) -> None:
+        with self._token_lock:
+            if generation == self._token_generation:
+                cache.set(key, value)
+
+    def token_cache_stats(self) -> dict:
+        return self._token_cache.stats()
+
+    def unknown_token_cache_stats(self) -> dict:
+        return self._unknown_token_cache.stats()
+
     @staticmethod
     def _to_user(record: UserRecord) -> User:
-        return User(
-            id=record.id,
-            name=record.name,
-            role=Role(record.role),
-            active=record.active,
-            api_token=record.api_token,
-            username=record.username,
-            password_hash=record.password_hash,
-        )
+        return user_from_record(record)
 
     def list_users(self) -> Iterable[User]:
-        with SessionLocal() as session:
+        with session_scope() as session:
             records = session.query(UserRecord).order_by(UserRecord.id.asc()).all()
             return [self._to_user(record) for record in records]
 
@@ -56,7 +127,7 @@ class UserStore:
         password_hash: Optional[str] = None,
     ) -> User:
         token = api_token or secrets.token_urlsafe(32)
-        with SessionLocal() as session:
+        with session_scope() as session:
             record = UserRecord(
                 name=name,
                 role=role.value,
@@ -68,25 +139,63 @@ class UserStore:
             session.add(record)
             session.commit()
             session.refresh(record)
+            with self._token_lock:
+                self._token_cache.pop(token)
+                self._token_generation += 1
+                self._unknown_token_cache.clear()
             return self._to_user(record)
 
     def get_by_token(self, token: str) -> Optional[User]:
-        with SessionLocal() as session:
+        cached = self._token_cache.get(token)
+        if cached is not None:
+            return cached
+        token_digest = hashlib.sha256(token.encode("utf-8")).digest()
+        if self._unknown_token_cache.get(token_digest):
+            return None
+        generation = self._token_generation
+        with session_scope() as session:
             record = session.query(UserRecord).filter(UserRecord.api_token == token).first()
-            return self._to_user(record) if record else None
+            if not record:
+                # Skip caching if a user was created meanwhile; this miss may predate its token.
+                self._cache_token_lookup(generation, self._unknown_token_cache, token_digest, True)
+                return None
+            user = self._to_user(record)
+        # Likewise skip it if a user was updated or deleted while this row was being read.
+        self._cache_token_lookup(generation, self._token_cache, token, user)
+        return user
 
     def get_by_id(self, user_id: int) -> Optional[User]:
-        with SessionLocal() as session:
+        with session_scope() as session:
             record = session.get(UserRecord, user_id)
             return self._to_user(record) if record else None
 
     def get_by_username(self, username: str) -> Optional[User]:
-        with SessionLocal() as session:
+        with session_scope() as session:
             record = session.query(UserRecord).filter(UserRecord.username == username).first()
             return self._to_user(record) if record else None
 
+    @staticmethod
+    def _active_admin_filter():
+        return (UserRecord.role == Role.ADMIN.value) & UserRecord.active.is_(True)
+
+    def count_active_admins(self) -> int:
+        with session_scope() as session:
+            return session.scalar(select(func.count()).select_from(UserRecord).where(self._active_admin_filter()))
+
+    def _guard_last_active_admin(self, session, user_id: int, statement):
+        # Lock the active admins where the dialect supports it; the correlated count keeps the
+        # statement itself conditional so concurrent demotions cannot both succeed on SQLite either.
+        session.execute(select(UserRecord.id).where(self._active_admin_filter()).with_for_update())
+        other_active_admins = (
+            select(func.count())
+            .select_from(UserRecord)
+            .where(self._active_admin_filter(), UserRecord.id != user_id)
+            .scalar_subquery()
+        )
+        return statement.where(other_active_admins > 0)
+
     def has_admin_user(self) -> bool:
-        with SessionLocal() as session:
+        with session_scope() as session:
             record = session.query(UserRecord.id).filter(UserRecord.role == Role.ADMIN.value).first()
             return record is not None
 
@@ -94,13 +203,34 @@ class UserStore:
         user = self.get_by_username(username)
         if not user or not user.password_hash:
             return None
-        if not check_password_hash(user.password_hash, password):
+        end_request_transaction()
+        if not password_hashing.verify_password(user.password_hash, password):
             return None
+        if password_hashing.needs_rehash(user.password_hash):
+            return self._upgrade_password_hash(user, password)
         return user
 
+    def _upgrade_password_hash(self, user: User, password: str) -> User:
+        try:
+            password_hash = password_hashing.hash_password(password)
+        except ServiceBusyError:
+            return user
+        with session_scope() as session:
+            updated = session.execute(
+                update(UserRecord)
+                .where(UserRecord.id == user.id, UserRecord.password_hash == user.password_hash)
+                .values(password_hash=password_hash)
+            ).rowcount
+            session.commit()
+        if not updated:
+            return user
+        self._invalidate_cached_user(user.id)
+        return replace(user, password_hash=password_hash)
+
     @staticmethod
     def hash_password(password: str) -> str:
-        return generate_password_hash(password)
+        end_request_transaction()
+        return password_hashing.hash_password(password)
 
     def update_user(
         self,
@@ -110,33 +240,61 @@ class UserStore:
         active: Optional[bool] = None,
         username: Optional[str] = None,
         password_hash: Optional[str] = None,
+        keep_active_admin: bool = False,
     ) -> Optional[User]:
-        with SessionLocal() as session:
+        values = {
+            "name": name,
+            "username": username,
+            "role": role.value if role is not None else None,
+            "active": active,
+            "password_hash": password_hash,
+        }
+        values = {key: value for key, value in values.items() if value is not None}
+        with session_scope() as session:
             record = session.get(UserRecord, user_id)
             if not record:
                 return None
-            if name is not None:
-                record.name = name
-            if username is not None:
-                record.username = username
-            if role is not None:
-                record.role = role.value
-            if active is not None:
-                record.active = active
-            if password_hash is not None:
-                record.password_hash = password_hash
+            removes_active_admin = (
+                record.role == Role.ADMIN.value
+                and record.active
+                and (values.get("role", record.role) != Role.ADMIN.value or not values.get("active", record.active))
+            )
+            if values:
+                guarded = keep_active_admin and removes_active_admin
+                statement = update(UserRecord).where(UserRecord.id == user_id).values(**values)
+                if guarded:
+                    statement = self._guard_last_active_admin(session, user_id, statement)
+                if session.execute(statement).rowcount == 0:
+                    session.rollback()
+                    if guarded:
+                        raise LastActiveAdminError(user_id)
+                    return None
             session.commit()
             session.refresh(record)
+            self._invalidate_cached_user(user_id)
             return self._to_user(record)
 
-    def delete_user(self, user_id: int) -> bool:
-        with SessionLocal() as session:
+    def delete_user(self, user_id: int, delete_devices: bool = False, keep_active_admin: bool = False) -> bool:
+        with session_scope() as session:
             record = session.get(UserRecord, user_id)
             if not record:
                 return False
-            session.delete(record)
+            guarded = keep_active_admin and record.role == Role.ADMIN.value and record.active
+            # Device rows reference the user, so they go first; a tripped guard rolls them back too.
+            if delete_devices:
+                session.execute(delete(DeviceAssignmentRecord).where(DeviceAssignmentRecord.user_id == user_id))
+                session.execute(delete(PendingDeviceRecord).where(PendingDeviceRecord.user_id == user_id))
+            statement = delete(UserRecord).where(UserRecord.id == user_id)
+            if guarded:
+                statement = self._guard_last_active_admin(session, user_id, statement)
+            if session.execute(statement).rowcount == 0:
+                session.rollback()
+                if guarded:
+                    raise LastActiveAdminError(user_id)
+                return False
             session.commit()
-            return True
+        self._invalidate_cached_user(user_id)
+        return True
 
 
 _STORE: Optional[UserStore] = None
@@ -153,7 +311,7 @@ def _bootstrap_admin(store: UserStore) -> None:
     admin_name = os.getenv("ADMIN_NAME", "Admin")
     admin_username = os.getenv("ADMIN_USERNAME", admin_name)
     admin_password = os.getenv("ADMIN_PASSWORD")
-    password_hash = store.hash_password(admin_password) if admin_password else None
+    password_hash = password_hashing.hash_password_blocking(admin_password) if admin_password else None
     store.create_user(
         name=admin_name,
         role=Role.ADMIN,
@@ -203,7 +361,7 @@ def _bootstrap_admin_interactive(store: UserStore) -> None:
         role=Role.ADMIN,
         active=True,
         username=username,
-        password_hash=store.hash_password(password),
+        password_hash=password_hashing.hash_password_blocking(password),
     )
     print(f"Admin-Benutzer '{username}' wurde erfolgreich erstellt.")
 